@@ -0,0 +1,98 @@
+import datetime
+import threading
+import time
+from collections import Counter, deque
+from urllib.parse import urlsplit
+from app.config import settings
+from app.crud import upsert_click_rollups
+from app.database import SessionLocal
+
+BUCKETS = ("minute", "hour", "day")
+
+# Кольцевой буфер событий перехода: добавление – O(1) без сети и блокировок,
+# при переполнении отбрасываются самые старые события
+events = deque(maxlen=settings.ANALYTICS_BUFFER_SIZE)
+
+def record_click_event(short_code: str, referrer: str, user_agent: str, country: str):
+    events.append((short_code, time.time(), referrer, user_agent, country))
+
+def referrer_host(referrer: str) -> str:
+    if not referrer:
+        return "direct"
+    host = urlsplit(referrer).hostname
+    return (host or "unknown")[:100]
+
+def classify_user_agent(user_agent: str) -> str:
+    if not user_agent:
+        return "unknown"
+    ua = user_agent.lower()
+    if any(marker in ua for marker in ("bot", "crawler", "spider", "curl", "wget", "python-requests", "httpx")):
+        return "bot"
+    if "ipad" in ua or "tablet" in ua:
+        return "tablet"
+    if "mobile" in ua or "android" in ua or "iphone" in ua:
+        return "mobile"
+    return "desktop"
+
+def normalize_country(country: str) -> str:
+    country = (country or "").strip().upper()
+    return country[:8] if country and country != "XX" else "unknown"
+
+def bucket_start(moment: datetime.datetime, bucket: str) -> datetime.datetime:
+    if bucket == "minute":
+        return moment.replace(second=0, microsecond=0)
+    if bucket == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def drain_events(limit: int = None):
+    # Забираем накопленные события и агрегируем их в памяти по всем корзинам
+    rollups = Counter()
+    drained = 0
+    while limit is None or drained < limit:
+        try:
+            short_code, ts, referrer, user_agent, country = events.popleft()
+        except IndexError:
+            break
+        drained += 1
+        moment = datetime.datetime.utcfromtimestamp(ts)
+        dims = (referrer_host(referrer), classify_user_agent(user_agent), normalize_country(country))
+        for bucket in BUCKETS:
+            rollups[(short_code, bucket, bucket_start(moment, bucket)) + dims] += 1
+    return rollups
+
+def flush_events(db):
+    rollups = drain_events()
+    if rollups:
+        upsert_click_rollups(db, rollups)
+    return sum(count for key, count in rollups.items() if key[1] == "minute")
+
+_stop_event = threading.Event()
+_thread = None
+
+def _flush_loop():
+    while not _stop_event.wait(settings.ANALYTICS_FLUSH_INTERVAL):
+        _flush_once()
+    # Остаток буфера пишем при остановке
+    _flush_once()
+
+def _flush_once():
+    db = SessionLocal()
+    try:
+        flush_events(db)
+    except Exception as e:
+        print(f"Ошибка при записи аналитики переходов: {e}")
+    finally:
+        db.close()
+
+def start_analytics_flusher():
+    # Буфер живёт в памяти веб-воркера, поэтому и сброс идёт в нём, независимо от планировщика
+    global _thread
+    _stop_event.clear()
+    _thread = threading.Thread(target=_flush_loop, name="analytics-flush", daemon=True)
+    _thread.start()
+
+def stop_analytics_flusher(timeout: float = 10.0):
+    _stop_event.set()
+    if _thread is not None:
+        _thread.join(timeout)
@@ -0,0 +1,234 @@
+import hashlib
+import math
+import time
+from collections import Counter
+import redis
+from app import models
+from app.caching import async_redis_client, redis_client
+from app.config import settings
+from app.sharding import on_shard, query_shards
+
+# Фильтр Блума по всем коротким кодам – битовая карта в Redis, общая для всех воркеров.
+# Отрицательный ответ точный: кода нет, и перенаправление отвечает 404 без запроса к БД.
+# Удалить код из фильтра Блума нельзя, поэтому удалённые коды остаются «возможно есть»
+# до следующей перестройки (задача bloom), что лишь возвращает их к обычному пути через БД.
+#
+# В хэше BLOOM_META_KEY хранятся текущий фильтр (current) и строящийся при перестройке (building):
+# имя ключа, число бит и число хэш-функций. Пока идёт перестройка, новые коды пишутся в оба.
+#
+# Если код не удалось записать в фильтр, ключ фильтра помечается «грязным» (BLOOM_DIRTY_PREFIX + ключ).
+# Пометка привязана к самому фильтру, а не к описанию, поэтому её видят и воркеры с устаревшим
+# описанием: по грязному фильтру отказов не бывает, проверка идёт через БД до перестройки (задача bloom-repair).
+BLOOM_META_KEY = "bloom:links:meta"
+BLOOM_KEY_PREFIX = "bloom:links:"
+BLOOM_DIRTY_PREFIX = "bloom:dirty:"
+BLOOM_REBUILD_LOCK_KEY = "bloom:rebuild-lock"
+
+bloom_stats = Counter()
+
+def bloom_parameters(capacity: int, error_rate: float, max_bytes: int):
+    # m = -n·ln(p) / ln(2)², k = m/n · ln(2); размер ограничен бюджетом памяти
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    bits = max(8, min(bits, max_bytes * 8))
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+def expected_error_rate(bits: int, hashes: int, count: int) -> float:
+    return (1 - math.exp(-hashes * count / bits)) ** hashes
+
+def positions(short_code: str, bits: int, hashes: int):
+    # Двойное хэширование: k позиций из двух 64-битных половин одного дайджеста
+    digest = hashlib.blake2b(short_code.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+def _parse_meta(raw: dict) -> dict:
+    meta = {}
+    for role in ("current", "building"):
+        if raw.get(role):
+            meta[role] = (raw[role], int(raw[f"{role}_bits"]), int(raw[f"{role}_hashes"]))
+    return meta
+
+# Описание фильтров кэшируется в процессе на BLOOM_META_TTL секунд; перестройка это учитывает
+_meta_cache = {"value": None, "expires": 0.0, "dirty_pending": set()}
+
+def _cached_meta():
+    if _meta_cache["dirty_pending"]:
+        _mark_dirty()
+        return {}
+    if _meta_cache["value"] is not None and _meta_cache["expires"] > time.monotonic():
+        return _meta_cache["value"]
+    return None
+
+def _store_meta(raw: dict) -> dict:
+    meta = _parse_meta(raw)
+    _meta_cache["value"] = meta
+    _meta_cache["expires"] = time.monotonic() + settings.BLOOM_META_TTL
+    return meta
+
+def get_meta() -> dict:
+    meta = _cached_meta()
+    if meta is None:
+        meta = _store_meta(redis_client.hgetall(BLOOM_META_KEY))
+    return meta
+
+async def get_meta_async() -> dict:
+    meta = _cached_meta()
+    if meta is None:
+        meta = _store_meta(await async_redis_client.hgetall(BLOOM_META_KEY))
+    return meta
+
+def _set_bits(pipe, filters, short_codes):
+    for key, bits, hashes in filters:
+        for short_code in short_codes:
+            for position in positions(short_code, bits, hashes):
+                pipe.setbit(key, position, 1)
+
+def add_codes(short_codes):
+    # Вызывается до фиксации вставки: код, который уже можно получить в ответе, всегда есть в фильтре
+    if not settings.BLOOM_ENABLED or not short_codes:
+        return
+    filters = []
+    try:
+        filters = list(get_meta().values())
+        if filters:
+            pipe = redis_client.pipeline(transaction=False)
+            _set_bits(pipe, filters, short_codes)
+            pipe.execute()
+    except redis.RedisError:
+        # Без записи в фильтр ссылка была бы недоступна – поэтому фильтр помечается грязным до перестройки
+        _mark_dirty(filters)
+
+async def add_codes_async(short_codes):
+    if not settings.BLOOM_ENABLED or not short_codes:
+        return
+    filters = []
+    try:
+        filters = list((await get_meta_async()).values())
+        if filters:
+            pipe = async_redis_client.pipeline(transaction=False)
+            _set_bits(pipe, filters, short_codes)
+            await pipe.execute()
+    except redis.RedisError:
+        _mark_dirty(filters)
+
+def _dirty_key(key: str) -> str:
+    return f"{BLOOM_DIRTY_PREFIX}{key}"
+
+def _mark_dirty(filters=()):
+    # Помечаются фильтры, в которые не удалось записать, и все фильтры из свежего описания.
+    # Если Redis недоступен, пометка повторяется при следующем обращении, а до тех пор
+    # этот воркер фильтром не пользуется
+    _meta_cache["value"] = None
+    pending = _meta_cache["dirty_pending"]
+    pending.update(key for key, _, _ in filters)
+    try:
+        pending.update(key for key, _, _ in _parse_meta(redis_client.hgetall(BLOOM_META_KEY)).values())
+        if pending:
+            pipe = redis_client.pipeline(transaction=False)
+            for key in pending:
+                # Пометка живёт не дольше двух перестроек: к тому времени фильтр заменён новым
+                pipe.set(_dirty_key(key), 1, ex=int(settings.BLOOM_REBUILD_INTERVAL * 2))
+            pipe.execute()
+    except redis.RedisError:
+        return
+    pending.clear()
+    print("Не удалось обновить фильтр Блума; до перестройки проверка идёт через БД")
+
+async def might_exist_async(short_code: str) -> bool:
+    # False – кода точно нет; при любой неопределённости (нет фильтра, ошибка Redis) – True
+    if not settings.BLOOM_ENABLED:
+        return True
+    try:
+        current = (await get_meta_async()).get("current")
+        if current is None:
+            return True
+        key, bits, hashes = current
+        pipe = async_redis_client.pipeline(transaction=False)
+        pipe.exists(_dirty_key(key))
+        for position in positions(short_code, bits, hashes):
+            pipe.getbit(key, position)
+        dirty, *bits_set = await pipe.execute()
+    except redis.RedisError:
+        return True
+    if dirty:
+        bloom_stats["dirty"] += 1
+        return True
+    present = all(bits_set)
+    bloom_stats["checks"] += 1
+    if not present:
+        bloom_stats["rejected"] += 1
+    return present
+
+def rebuild_filter(db, batch_size: int = None):
+    # Перестройка без простоя: новый фильтр объявляется строящимся (в него сразу пишут создания),
+    # заполняется из таблицы links и атомарно становится текущим. Старый ключ живёт ещё два
+    # срока кэша описания, чтобы воркеры с устаревшим описанием не получили ложный отказ
+    if not settings.BLOOM_ENABLED:
+        return 0
+    # Плановая перестройка и досрочная (repair_filter) не должны строить два фильтра одновременно
+    if not redis_client.set(BLOOM_REBUILD_LOCK_KEY, 1, nx=True, ex=int(settings.BLOOM_REBUILD_LOCK_TIMEOUT)):
+        return 0
+    try:
+        return _rebuild_filter(db, batch_size)
+    finally:
+        redis_client.delete(BLOOM_REBUILD_LOCK_KEY)
+
+def _rebuild_filter(db, batch_size: int = None):
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    bits, hashes = bloom_parameters(settings.BLOOM_CAPACITY, settings.BLOOM_ERROR_RATE, settings.BLOOM_MAX_BYTES)
+    key = f"{BLOOM_KEY_PREFIX}{time.time_ns()}"
+    redis_client.hset(BLOOM_META_KEY, mapping={"building": key, "building_bits": bits, "building_hashes": hashes})
+    # Ждём, пока все воркеры увидят строящийся фильтр, и только потом читаем таблицу
+    time.sleep(settings.BLOOM_META_TTL + 1)
+
+    Link = models.Link
+    total = 0
+    for shard_id in query_shards():
+        last_id = 0
+        while True:
+            query = db.query(Link.id, Link.short_code).filter(Link.id > last_id).order_by(Link.id).limit(batch_size)
+            rows = on_shard(query, shard_id).all()
+            if not rows:
+                break
+            pipe = redis_client.pipeline(transaction=False)
+            _set_bits(pipe, [(key, bits, hashes)], [row.short_code for row in rows])
+            pipe.execute()
+            last_id = rows[-1].id
+            total += len(rows)
+    db.rollback()
+
+    previous = redis_client.hget(BLOOM_META_KEY, "current")
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(BLOOM_META_KEY, mapping={"current": key, "current_bits": bits, "current_hashes": hashes})
+    pipe.hdel(BLOOM_META_KEY, "building", "building_bits", "building_hashes")
+    if previous and previous != key:
+        pipe.expire(previous, int(settings.BLOOM_META_TTL * 2) + 1)
+        pipe.expire(_dirty_key(previous), int(settings.BLOOM_META_TTL * 2) + 1)
+    pipe.execute()
+    _meta_cache["expires"] = 0.0
+    if total > settings.BLOOM_CAPACITY:
+        print(f"Фильтр Блума: {total} кодов больше BLOOM_CAPACITY, вероятность ложного срабатывания "
+              f"{expected_error_rate(bits, hashes, total):.4f}")
+    return total
+
+def repair_filter(db):
+    # Частая проверка: грязный текущий фильтр перестраивается сразу, не дожидаясь плановой перестройки
+    if not settings.BLOOM_ENABLED:
+        return 0
+    current = _parse_meta(redis_client.hgetall(BLOOM_META_KEY)).get("current")
+    if current is None or not redis_client.exists(_dirty_key(current[0])):
+        return 0
+    print("Фильтр Блума помечен грязным; перестройка")
+    return rebuild_filter(db)
+
+def filter_stats() -> dict:
+    stats = dict(bloom_stats)
+    try:
+        current = get_meta().get("current")
+    except redis.RedisError:
+        current = None
+    if current:
+        stats.update(key=current[0], bits=current[1], hashes=current[2])
+    return stats
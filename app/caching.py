@@ -1,18 +1,722 @@
+import asyncio
 import json
+import random
+import time
+import datetime
+import threading
+import uuid
+from collections import Counter, OrderedDict
 import redis
+import redis.asyncio
 from app.config import settings
 
-redis_client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
-CACHE_EXPIRATION = 60 * 60  # кэш на 1 час
+REDIS_POOL_OPTIONS = {
+    "max_connections": settings.REDIS_MAX_CONNECTIONS,
+    "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+    "socket_connect_timeout": settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+    "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL,
+}
 
-def get_cached_link(short_code: str):
-    data = redis_client.get(f"link:{short_code}")
-    if data:
-        return json.loads(data)
+redis_client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True, **REDIS_POOL_OPTIONS)
+# Асинхронный клиент для обработчиков, работающих в event loop
+async_redis_client = redis.asyncio.Redis.from_url(settings.REDIS_URL, decode_responses=True, **REDIS_POOL_OPTIONS)
+# Подписка ждёт сообщений сколь угодно долго, поэтому у неё отдельное соединение без таймаута чтения
+pubsub_client = redis.Redis.from_url(
+    settings.REDIS_URL,
+    decode_responses=True,
+    socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+    health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+)
+# Снятие блокировки только своим токеном: по истечении таймаута её мог взять другой воркер
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+release_lock = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+release_lock_async = async_redis_client.register_script(RELEASE_LOCK_SCRIPT)
+# Продление блокировки (в миллисекундах), пока она у владельца токена
+RENEW_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+renew_lock = redis_client.register_script(RENEW_LOCK_SCRIPT)
+
+# Запись из БД кладётся, только если у кода нет надгробия: загрузка, прочитавшая строку до удаления,
+# иначе вернула бы удалённую ссылку в кэш на весь срок
+STORE_FILL_SCRIPT = """
+if redis.call("exists", KEYS[2]) == 1 then
+    return 0
+end
+redis.call("set", KEYS[1], ARGV[1], "EX", ARGV[2])
+return 1
+"""
+store_fill_async = async_redis_client.register_script(STORE_FILL_SCRIPT)
+
+CACHE_EXPIRATION = settings.CACHE_EXPIRATION  # кэш на 1 час
+NEGATIVE_CACHE_EXPIRATION = settings.NEGATIVE_CACHE_EXPIRATION
+# Обновления записей и заполнения после промаха: refreshes, refresh_errors, stale, fills, coalesced,
+# lock_waits, lock_served, lock_timeouts, tombstoned (загрузка не вернула в кэш удалённую ссылку)
+fill_stats = Counter()
+
+# Маркеры отрицательного кэширования: ссылки нет или она устарела
+LINK_MISSING = "missing"
+LINK_EXPIRED = "expired"
+
+class LocalCache:
+    # Ограниченный LRU-кэш с TTL в памяти процесса
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            value, expires = item
+            if expires < now:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value, ttl: int = None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+local_cache = LocalCache(settings.LOCAL_CACHE_SIZE, settings.LOCAL_CACHE_TTL)
+identity_cache = LocalCache(settings.IDENTITY_CACHE_SIZE, settings.IDENTITY_CACHE_TTL)
+USER_INVALIDATION_CHANNEL = f"{settings.CACHE_INVALIDATION_CHANNEL}:users"
+# Обращения к Redis за ссылками после промаха локального кэша: hits, misses, errors
+redis_cache_stats = Counter()
+
+def _key(short_code: str) -> str:
+    return f"link:{short_code}"
+
+def _search_key(url_hash: str) -> str:
+    return f"search:{url_hash}"
+
+def _fill_lock_key(short_code: str) -> str:
+    return f"fill-lock:{short_code}"
+
+def _tombstone_key(short_code: str) -> str:
+    return f"link-deleted:{short_code}"
+
+def _jittered(ttl: int) -> int:
+    jitter = settings.CACHE_TTL_JITTER
+    return max(1, round(ttl * random.uniform(1 - jitter, 1 + jitter)))
+
+def expiry_timestamp(expires_at):
+    # Unix-время истечения ссылки; expires_at – datetime или ISO-строка, без часового пояса – UTC
+    if isinstance(expires_at, str):
+        expires_at = datetime.datetime.fromisoformat(expires_at)
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+    return expires_at.timestamp()
+
+def _seconds_left(link_data: dict):
+    if not link_data.get("expires_at"):
+        return None
+    return expiry_timestamp(link_data["expires_at"]) - time.time()
+
+def link_ttl(link_data: dict = None) -> int:
+    # Запись живёт в Redis срок кэша (с разбросом) плюс окно, в котором отдаётся устаревшей,
+    # но не дольше самой ссылки
+    ttl = _jittered(CACHE_EXPIRATION) + settings.CACHE_STALE_TTL
+    seconds_left = _seconds_left(link_data) if link_data else None
+    if seconds_left is not None:
+        ttl = min(ttl, max(1, int(seconds_left)))
+    return ttl
+
+def missing_ttl() -> int:
+    return _jittered(NEGATIVE_CACHE_EXPIRATION)
+
+def cache_entry(original_url: str, expires_at=None, redirect_status: int = None, exact_clicks: bool = False) -> dict:
+    entry = {
+        "original_url": original_url,
+        "expires_at": expires_at.isoformat() if expires_at else None,
+    }
+    # Значения по умолчанию не храним, чтобы не раздувать записи кэша
+    if redirect_status:
+        entry["redirect_status"] = redirect_status
+    if exact_clicks:
+        entry["exact_clicks"] = True
+    return entry
+
+def link_to_cache(db_link) -> dict:
+    return cache_entry(db_link.original_url, db_link.expires_at, db_link.redirect_status, db_link.exact_clicks)
+
+def delete_cached_link(short_code: str, deleted: bool = False):
+    # deleted – ссылка удалена: сначала ставится надгробие, затем удаляется запись. При создании
+    # (сброс отрицательной записи) надгробие, наоборот, снимается
+    local_cache.delete(short_code)
+    try:
+        if deleted:
+            redis_client.setex(_tombstone_key(short_code), settings.CACHE_TOMBSTONE_TTL, 1)
+            redis_client.delete(_key(short_code))
+        else:
+            redis_client.delete(_key(short_code), _tombstone_key(short_code))
+        # Сообщаем остальным воркерам, что локальную копию нужно сбросить
+        redis_client.publish(settings.CACHE_INVALIDATION_CHANNEL, short_code)
+    except redis.RedisError:
+        pass
+
+async def get_cached_link_async(short_code: str, refresh=None):
+    # refresh – корутина-функция загрузки записи из БД: если срок записи в Redis уже вышел и она
+    # отдаётся из окна CACHE_STALE_TTL, обновление запускается в фоне
+    data = local_cache.get(short_code)
+    if data is not None:
+        return data
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        pipe.get(_key(short_code))
+        pipe.pttl(_key(short_code))
+        raw, pttl = await pipe.execute()
+    except redis.RedisError:
+        redis_cache_stats["errors"] += 1
+        return None
+    if raw:
+        redis_cache_stats["hits"] += 1
+        data = json.loads(raw)
+        if "status" in data:
+            local_cache.set(short_code, data, NEGATIVE_CACHE_EXPIRATION)
+            return data
+        # Локально запись живёт не дольше, чем в Redis: там срок ограничен и временем жизни ссылки
+        local_cache.set(short_code, data, max(1, pttl // 1000) if pttl >= 0 else None)
+        seconds_left = _seconds_left(data)
+        if 0 <= pttl <= settings.CACHE_STALE_TTL * 1000 and (seconds_left is None or seconds_left > settings.CACHE_STALE_TTL):
+            # Запись ссылки, которая скоро истекает, подходит к концу срока не из-за кэша – её не обновляем
+            fill_stats["stale"] += 1
+            if refresh is not None:
+                _start_refresh(short_code, refresh)
+        return data
+    redis_cache_stats["misses"] += 1
+    return None
+
+async def set_cached_link_async(short_code: str, link_data: dict):
+    ttl = link_ttl(link_data)
+    local_cache.set(short_code, link_data, ttl)
+    try:
+        await async_redis_client.setex(_key(short_code), ttl, json.dumps(link_data))
+    except redis.RedisError:
+        pass
+
+async def set_missing_link_async(short_code: str, reason: str = LINK_MISSING):
+    data = {"status": reason}
+    local_cache.set(short_code, data, NEGATIVE_CACHE_EXPIRATION)
+    try:
+        await async_redis_client.setex(_key(short_code), missing_ttl(), json.dumps(data))
+    except redis.RedisError:
+        pass
+
+async def delete_cached_link_async(short_code: str):
+    # Сброс записи при создании ссылки; удаление ссылок идёт через delete_cached_link(s)
+    local_cache.delete(short_code)
+    try:
+        await async_redis_client.delete(_key(short_code), _tombstone_key(short_code))
+        await async_redis_client.publish(settings.CACHE_INVALIDATION_CHANNEL, short_code)
+    except redis.RedisError:
+        pass
+
+# Заполнение кэша ссылок из БД без лавины запросов: в процессе на код выполняется одна загрузка
+# (остальные запросы ждут её результата), а между воркерами – та, что взяла блокировку в Redis
+_fills = {}
+_refreshes = {}
+
+async def _acquire_fill_lock(short_code: str):
+    # Токен взятой блокировки или None, если она у другого воркера.
+    # Без Redis блокировки нет ("" – грузим сами): каждый воркер загружает сам, но по одному разу на код
+    token = uuid.uuid4().hex
+    try:
+        taken = await async_redis_client.set(
+            _fill_lock_key(short_code), token, nx=True, px=int(settings.CACHE_FILL_LOCK_TIMEOUT * 1000)
+        )
+    except redis.RedisError:
+        return ""
+    return token if taken else None
+
+async def _release_fill_lock(short_code: str, token):
+    if not token:
+        return
+    try:
+        await release_lock_async(keys=[_fill_lock_key(short_code)], args=[token])
+    except redis.RedisError:
+        pass
+
+async def _wait_for_fill(short_code: str):
+    # Запись, которую кладёт в Redis воркер с блокировкой, или None, если не дождались
+    deadline = time.monotonic() + settings.CACHE_FILL_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(settings.CACHE_FILL_POLL_INTERVAL)
+        try:
+            raw = await async_redis_client.get(_key(short_code))
+        except redis.RedisError:
+            return None
+        if raw:
+            data = json.loads(raw)
+            local_cache.set(short_code, data, NEGATIVE_CACHE_EXPIRATION if "status" in data else None)
+            return data
+    return None
+
+async def _store_fill(short_code: str, data):
+    if data is None:
+        await set_missing_link_async(short_code)
+        return {"status": LINK_MISSING}
+    # Локальная копия кладётся до записи в Redis: сообщение об удалении, пришедшее после, её сбросит
+    ttl = link_ttl(data)
+    local_cache.set(short_code, data, ttl)
+    try:
+        stored = await store_fill_async(keys=[_key(short_code), _tombstone_key(short_code)], args=[json.dumps(data), ttl])
+    except redis.RedisError:
+        return data
+    if not stored:
+        # Ссылку удалили, пока шла загрузка
+        local_cache.delete(short_code)
+        fill_stats["tombstoned"] += 1
+        return {"status": LINK_MISSING}
+    return data
+
+async def _fill(short_code: str, load):
+    token = await _acquire_fill_lock(short_code)
+    if token is None:
+        fill_stats["lock_waits"] += 1
+        data = await _wait_for_fill(short_code)
+        if data is not None:
+            fill_stats["lock_served"] += 1
+            return data
+        # Не дождались – грузим сами, но чужую блокировку не снимаем
+        fill_stats["lock_timeouts"] += 1
+    fill_stats["fills"] += 1
+    try:
+        return await _store_fill(short_code, await load())
+    finally:
+        await _release_fill_lock(short_code, token)
+
+def _forget(tasks: dict, short_code: str, task):
+    if tasks.get(short_code) is task:
+        del tasks[short_code]
+    # Ошибку уже получили ожидавшие запросы; без них – не засоряем лог предупреждением asyncio
+    if not task.cancelled():
+        task.exception()
+
+async def fill_cached_link_async(short_code: str, load):
+    # load – корутина-функция, возвращающая запись кэша по данным БД или None, если ссылки нет.
+    # Результат – запись кэша или маркер {"status": LINK_MISSING}
+    task = _fills.get(short_code)
+    if task is None:
+        task = _fills[short_code] = asyncio.create_task(_fill(short_code, load))
+        task.add_done_callback(lambda done: _forget(_fills, short_code, done))
+    else:
+        fill_stats["coalesced"] += 1
+    # Отключившийся клиент не отменяет загрузку, которую ждут другие запросы
+    return await asyncio.shield(task)
+
+async def _refresh(short_code: str, load):
+    token = await _acquire_fill_lock(short_code)
+    if token is None:
+        return
+    fill_stats["refreshes"] += 1
+    try:
+        await _store_fill(short_code, await load())
+    except Exception:
+        # Запись остаётся устаревшей до следующего обращения; ошибки видны в метрике refresh_errors
+        fill_stats["refresh_errors"] += 1
+    finally:
+        await _release_fill_lock(short_code, token)
+
+def _start_refresh(short_code: str, load):
+    if short_code in _refreshes or short_code in _fills:
+        return
+    task = _refreshes[short_code] = asyncio.create_task(_refresh(short_code, load))
+    task.add_done_callback(lambda done: _forget(_refreshes, short_code, done))
+
+async def set_cached_links_async(links: dict, invalidate=(), search_hashes=()):
+    # Прогрев кэша пачкой новых ссылок одним пайплайном
+    for short_code in invalidate:
+        local_cache.delete(short_code)
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        for short_code, link_data in links.items():
+            pipe.setex(_key(short_code), link_ttl(link_data), json.dumps(link_data))
+        for short_code in invalidate:
+            pipe.publish(settings.CACHE_INVALIDATION_CHANNEL, short_code)
+        if search_hashes:
+            pipe.delete(*[_search_key(h) for h in search_hashes])
+        await pipe.execute()
+    except redis.RedisError:
+        pass
+
+# Кэш обратного поиска по хэшу URL; "null" – отрицательный результат
+def get_cached_search(url_hash: str):
+    try:
+        return redis_client.get(_search_key(url_hash))
+    except redis.RedisError:
+        return None
+
+def set_cached_search(url_hash: str, payload: str):
+    try:
+        redis_client.setex(_search_key(url_hash), settings.SEARCH_CACHE_EXPIRATION, payload)
+    except redis.RedisError:
+        pass
+
+def delete_cached_search(url_hash: str):
+    if not url_hash:
+        return
+    try:
+        redis_client.delete(_search_key(url_hash))
+    except redis.RedisError:
+        pass
+
+async def delete_cached_search_async(url_hash: str):
+    try:
+        await async_redis_client.delete(_search_key(url_hash))
+    except redis.RedisError:
+        pass
+
+# Метки недавних записей для read-your-writes: пока метка жива, чтение идёт в основную БД,
+# а не в реплику, которая может ещё не получить изменение. Ключи: link:<код>, user:<id>, search:<хэш>
+def recent_write_keys(short_code: str = None, owner_id: int = None, url_hash: str = None):
+    keys = []
+    if short_code:
+        keys.append(f"link:{short_code}")
+    if owner_id is not None:
+        keys.append(f"user:{owner_id}")
+    if url_hash:
+        keys.append(f"search:{url_hash}")
+    return keys
+
+def _recent_write_key(key: str) -> str:
+    return f"recent-write:{key}"
+
+def mark_recent_writes(keys):
+    if not settings.DATABASE_READ_URLS or not keys:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.setex(_recent_write_key(key), settings.READ_YOUR_WRITES_SECONDS, 1)
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+async def mark_recent_writes_async(keys):
+    if not settings.DATABASE_READ_URLS or not keys:
+        return
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.setex(_recent_write_key(key), settings.READ_YOUR_WRITES_SECONDS, 1)
+        await pipe.execute()
+    except redis.RedisError:
+        pass
+
+def has_recent_write(keys) -> bool:
+    # Если Redis недоступен, считаем, что запись была: лишнее чтение из основной БД безопаснее
+    try:
+        return bool(redis_client.exists(*[_recent_write_key(key) for key in keys]))
+    except redis.RedisError:
+        return True
+
+async def has_recent_write_async(keys) -> bool:
+    try:
+        return bool(await async_redis_client.exists(*[_recent_write_key(key) for key in keys]))
+    except redis.RedisError:
+        return True
+
+# Кэш проверенных пользователей (по username из sub): в памяти процесса и в Redis
+def _user_key(username: str) -> str:
+    return f"user:{username}"
+
+def get_cached_identity(username: str):
+    data = identity_cache.get(username)
+    if data is not None:
+        return data
+    try:
+        raw = redis_client.get(_user_key(username))
+    except redis.RedisError:
+        return None
+    if raw:
+        data = json.loads(raw)
+        identity_cache.set(username, data)
+        return data
     return None
 
-def set_cached_link(short_code: str, link_data: dict):
-    redis_client.setex(f"link:{short_code}", CACHE_EXPIRATION, json.dumps(link_data))
+async def get_cached_identity_async(username: str):
+    data = identity_cache.get(username)
+    if data is not None:
+        return data
+    try:
+        raw = await async_redis_client.get(_user_key(username))
+    except redis.RedisError:
+        return None
+    if raw:
+        data = json.loads(raw)
+        identity_cache.set(username, data)
+        return data
+    return None
+
+def set_cached_identity(username: str, identity: dict):
+    identity_cache.set(username, identity)
+    try:
+        redis_client.setex(_user_key(username), settings.IDENTITY_CACHE_TTL, json.dumps(identity))
+    except redis.RedisError:
+        pass
+
+async def set_cached_identity_async(username: str, identity: dict):
+    identity_cache.set(username, identity)
+    try:
+        await async_redis_client.setex(_user_key(username), settings.IDENTITY_CACHE_TTL, json.dumps(identity))
+    except redis.RedisError:
+        pass
+
+def invalidate_identity(username: str):
+    # Вызывать при удалении пользователя или смене пароля
+    identity_cache.delete(username)
+    try:
+        redis_client.delete(_user_key(username))
+        redis_client.publish(USER_INVALIDATION_CHANNEL, username)
+    except redis.RedisError:
+        pass
+
+# Буфер счётчиков переходов: клики копятся в хэшах Redis и пачкой сбрасываются в БД
+CLICKS_COUNT_KEY = "clicks:count"
+CLICKS_LAST_KEY = "clicks:last"
+CLICKS_FLUSHING_COUNT_KEY = "clicks:count:flushing"
+CLICKS_FLUSHING_LAST_KEY = "clicks:last:flushing"
+CLICKS_FLUSH_LOCK_KEY = "clicks:flush-lock"
+
+async def record_click_async(short_code: str, accessed_at: datetime.datetime) -> bool:
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        pipe.hincrby(CLICKS_COUNT_KEY, short_code, 1)
+        pipe.hset(CLICKS_LAST_KEY, short_code, accessed_at.isoformat())
+        await pipe.execute()
+        return True
+    except redis.RedisError:
+        return False
+
+async def record_clicks_async(counts: dict, lasts: dict) -> bool:
+    # Переходы, накопленные в процессе (парк перенаправлений), одним пайплайном
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        for short_code, delta in counts.items():
+            pipe.hincrby(CLICKS_COUNT_KEY, short_code, delta)
+        pipe.hset(CLICKS_LAST_KEY, mapping={code: accessed_at.isoformat() for code, accessed_at in lasts.items()})
+        await pipe.execute()
+        return True
+    except redis.RedisError:
+        return False
+
+def _pending_clicks_pipeline(pipe, short_code: str):
+    pipe.hget(CLICKS_COUNT_KEY, short_code)
+    pipe.hget(CLICKS_FLUSHING_COUNT_KEY, short_code)
+    pipe.hget(CLICKS_LAST_KEY, short_code)
+    pipe.hget(CLICKS_FLUSHING_LAST_KEY, short_code)
+    return pipe
+
+def _merge_pending_clicks(count, flushing_count, last, flushing_last):
+    last_values = [datetime.datetime.fromisoformat(v) for v in (last, flushing_last) if v]
+    return int(count or 0) + int(flushing_count or 0), max(last_values) if last_values else None
+
+def get_pending_clicks(short_code: str):
+    # Ещё не сброшенные в БД клики (включая пачку, которая сбрасывается прямо сейчас)
+    try:
+        pipe = _pending_clicks_pipeline(redis_client.pipeline(transaction=False), short_code)
+        return _merge_pending_clicks(*pipe.execute())
+    except redis.RedisError:
+        return 0, None
+
+async def get_pending_clicks_async(short_code: str):
+    try:
+        pipe = _pending_clicks_pipeline(async_redis_client.pipeline(transaction=False), short_code)
+        return _merge_pending_clicks(*(await pipe.execute()))
+    except redis.RedisError:
+        return 0, None
+
+def take_pending_clicks(lock_timeout: int = 60):
+    # Забирает накопленные клики под блокировкой; возвращает None, если сбрасывает другой воркер
+    if not redis_client.set(CLICKS_FLUSH_LOCK_KEY, "1", nx=True, ex=lock_timeout):
+        return None
+    try:
+        # Незавершённая пачка от упавшего сброса обрабатывается первой
+        if not redis_client.exists(CLICKS_FLUSHING_COUNT_KEY):
+            if not redis_client.exists(CLICKS_COUNT_KEY):
+                return {}, {}
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.rename(CLICKS_COUNT_KEY, CLICKS_FLUSHING_COUNT_KEY)
+            pipe.rename(CLICKS_LAST_KEY, CLICKS_FLUSHING_LAST_KEY)
+            pipe.execute(raise_on_error=False)
+        counts = redis_client.hgetall(CLICKS_FLUSHING_COUNT_KEY)
+        lasts = redis_client.hgetall(CLICKS_FLUSHING_LAST_KEY)
+        return counts, lasts
+    except redis.RedisError:
+        redis_client.delete(CLICKS_FLUSH_LOCK_KEY)
+        raise
+
+def ack_pending_clicks():
+    redis_client.delete(CLICKS_FLUSHING_COUNT_KEY, CLICKS_FLUSHING_LAST_KEY, CLICKS_FLUSH_LOCK_KEY)
+
+# Очередь истечения ссылок: ZSET код -> unix-время expires_at. Задача expiring раз в несколько секунд
+# забирает наступившие сроки и архивирует эти ссылки; периодическая очистка по индексу остаётся страховкой
+EXPIRY_QUEUE_KEY = "links:expiring"
+
+def _expiry_scores(expirations: dict) -> dict:
+    return {code: expiry_timestamp(expires_at) for code, expires_at in expirations.items() if expires_at}
+
+def schedule_expiry(expirations: dict):
+    # expirations – {код: expires_at}; ссылки без срока пропускаются
+    scores = _expiry_scores(expirations)
+    if not scores:
+        return
+    try:
+        redis_client.zadd(EXPIRY_QUEUE_KEY, scores)
+    except redis.RedisError:
+        pass
+
+async def schedule_expiry_async(expirations: dict):
+    scores = _expiry_scores(expirations)
+    if not scores:
+        return
+    try:
+        await async_redis_client.zadd(EXPIRY_QUEUE_KEY, scores)
+    except redis.RedisError:
+        pass
+
+def due_expiries(limit: int):
+    return redis_client.zrangebyscore(EXPIRY_QUEUE_KEY, "-inf", time.time(), start=0, num=limit)
+
+def ack_expiries(short_codes):
+    if short_codes:
+        redis_client.zrem(EXPIRY_QUEUE_KEY, *short_codes)
+
+# Популярные коды по числу переходов: пополняется при сбросе счётчиков, читается при прогреве воркера
+HOT_LINKS_KEY = "links:hot"
+
+def record_hot_links(counts: dict):
+    if not counts:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for short_code, delta in counts.items():
+            pipe.zincrby(HOT_LINKS_KEY, int(delta), short_code)
+        pipe.zremrangebyrank(HOT_LINKS_KEY, 0, -settings.HOT_LINKS_TRACKED - 1)
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+async def get_hot_links_async(limit: int):
+    # Возвращает (коды, {код: запись кэша}) – записи только для кодов, уже лежащих в Redis
+    codes = await async_redis_client.zrevrange(HOT_LINKS_KEY, 0, limit - 1)
+    if not codes:
+        return [], {}
+    raw = await async_redis_client.mget([_key(code) for code in codes])
+    return codes, {code: json.loads(value) for code, value in zip(codes, raw) if value}
+
+def release_clicks_lock():
+    try:
+        redis_client.delete(CLICKS_FLUSH_LOCK_KEY)
+    except redis.RedisError:
+        pass
+
+def delete_cached_links(short_codes, search_hashes=()):
+    # Инвалидация пачки кодов одним пайплайном (для фоновой очистки)
+    if not short_codes:
+        return
+    for short_code in short_codes:
+        local_cache.delete(short_code)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for short_code in short_codes:
+            pipe.setex(_tombstone_key(short_code), settings.CACHE_TOMBSTONE_TTL, 1)
+        pipe.delete(*[_key(short_code) for short_code in short_codes])
+        search_keys = [_search_key(h) for h in search_hashes if h]
+        if search_keys:
+            pipe.delete(*search_keys)
+        for short_code in short_codes:
+            pipe.publish(settings.CACHE_INVALIDATION_CHANNEL, short_code)
+        pipe.execute()
+    except redis.RedisError:
+        pass
+
+def _listen_invalidations():
+    while True:
+        pubsub = None
+        try:
+            pubsub = pubsub_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(settings.CACHE_INVALIDATION_CHANNEL, USER_INVALIDATION_CHANNEL)
+            # Пока подписки не было, сообщения могли потеряться
+            local_cache.clear()
+            identity_cache.clear()
+            for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                if message["channel"] == USER_INVALIDATION_CHANNEL:
+                    identity_cache.delete(message["data"])
+                else:
+                    local_cache.delete(message["data"])
+        except Exception as e:
+            print(f"Ошибка подписки на инвалидацию кэша: {e}")
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+        time.sleep(1)
+
+def _redis_pool_stats(client) -> dict:
+    pool = getattr(client, "connection_pool", None)
+    try:
+        return {
+            "max_connections": pool.max_connections,
+            "created": pool._created_connections,
+            "in_use": len(pool._in_use_connections),
+            "idle": len(pool._available_connections),
+        }
+    except Exception:
+        return {}
+
+def redis_pool_stats() -> dict:
+    return {"sync": _redis_pool_stats(redis_client), "async": _redis_pool_stats(async_redis_client)}
 
-def delete_cached_link(short_code: str):
-    redis_client.delete(f"link:{short_code}")
+def start_invalidation_listener():
+    thread = threading.Thread(target=_listen_invalidations, daemon=True)
+    thread.start()
@@ -0,0 +1,62 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import format_datetime
+from urllib.parse import quote
+from app.config import settings
+
+# Кэширование перенаправлений в браузере и на CDN. Каждый ответ помечается ключом link-<код>,
+# по которому CDN очищается при удалении или обновлении ссылки
+NO_STORE = "private, no-store"
+# Столько ключей принимает за один запрос API очистки Fastly
+PURGE_BATCH_SIZE = 256
+
+def surrogate_key(short_code: str) -> str:
+    # Заголовки – latin-1, а алиас может быть любым: кодируем как в URL
+    return f"link-{quote(short_code, safe='')}"
+
+def redirect_status(cached: dict) -> int:
+    return cached.get("redirect_status") or settings.REDIRECT_STATUS
+
+def redirect_headers(short_code: str, cached: dict, now: datetime.datetime) -> dict:
+    # Ссылки с точным подсчётом переходов не кэшируются: каждый переход должен дойти до сервера
+    max_age = settings.REDIRECT_CACHE_MAX_AGE
+    edge_max_age = settings.REDIRECT_EDGE_MAX_AGE
+    if cached["expires_at"]:
+        remaining = int((datetime.datetime.fromisoformat(cached["expires_at"]) - now).total_seconds())
+        max_age = min(max_age, remaining)
+        edge_max_age = min(edge_max_age, remaining)
+    if cached.get("exact_clicks") or (max_age <= 0 and edge_max_age <= 0):
+        return {"Cache-Control": NO_STORE}
+    max_age = max(max_age, 0)
+    expires = (now + datetime.timedelta(seconds=max_age)).replace(tzinfo=datetime.timezone.utc)
+    return {
+        "Cache-Control": f"public, max-age={max_age}, s-maxage={max(edge_max_age, 0)}",
+        "Expires": format_datetime(expires, usegmt=True),
+        settings.SURROGATE_KEY_HEADER: surrogate_key(short_code),
+    }
+
+# Поток создаётся при первой очистке
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cdn-purge")
+
+def _send_purge(keys):
+    # httpx нужен только при очистке – не замедляем им импорт приложения
+    import httpx
+    headers = {settings.SURROGATE_KEY_HEADER: " ".join(keys)}
+    if settings.CDN_PURGE_TOKEN:
+        headers[settings.CDN_PURGE_AUTH_HEADER] = settings.CDN_PURGE_TOKEN
+    try:
+        # Ключи передаются и заголовком (Fastly), и телом {"tags": [...]} (Cloudflare)
+        response = httpx.post(
+            settings.CDN_PURGE_URL, headers=headers, json={"tags": keys}, timeout=settings.CDN_PURGE_TIMEOUT
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        print(f"Не удалось очистить CDN ({len(keys)} ключей): {e}")
+
+def purge_links(short_codes):
+    # Очистка идёт в отдельном потоке: удаление ссылки не ждёт ответа CDN
+    if not settings.CDN_PURGE_URL or not short_codes:
+        return
+    keys = [surrogate_key(code) for code in short_codes]
+    for i in range(0, len(keys), PURGE_BATCH_SIZE):
+        _executor.submit(_send_purge, keys[i:i + PURGE_BATCH_SIZE])
@@ -1,74 +1,182 @@
 import datetime
-import random
-import string
+import time
+from collections import Counter
+from sqlalchemy import DateTime, and_, bindparam, delete, func, insert, literal, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from app import models, schemas
 from app.config import settings
-from app.utils import generate_short_code
-from passlib.context import CryptContext
+from app.shortcodes import next_short_code
+from app.bloom import add_codes
+from app.cdn import purge_links
+from app.snapshot import publish_link_changes
+from app.sharding import on_shard, query_shards, shard_bind, sharding_enabled, split_by_shard
+from app.utils import url_hash
+from app.caching import (
+    delete_cached_link, delete_cached_links,
+    get_cached_search, set_cached_search, delete_cached_search, invalidate_identity, get_pending_clicks,
+    link_to_cache, mark_recent_writes, recent_write_keys, record_hot_links,
+    take_pending_clicks, ack_pending_clicks, release_clicks_lock, schedule_expiry, due_expiries, ack_expiries
+)
+from app.security import hash_password
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+CODE_ALLOCATION_ATTEMPTS = 5
+ROLLUP_BATCH_SIZE = 500
 
 # Пользователи
 def get_user_by_username(db: Session, username: str):
     return db.query(models.User).filter(models.User.username == username).first()
 
 def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = hash_password(user.password)
     db_user = models.User(username=user.username, hashed_password=hashed_password)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    # Пользователь с тем же именем мог быть удалён и остаться в кэше
+    invalidate_identity(db_user.username)
     return db_user
 
+def update_password_hash(db: Session, db_user: models.User, hashed_password: str):
+    db_user.hashed_password = hashed_password
+    db.commit()
+    invalidate_identity(db_user.username)
+
 # Ссылки
 def create_link(db: Session, link: schemas.LinkCreate, owner_id: int = None):
-    if link.custom_alias:
-        existing = db.query(models.Link).filter(models.Link.custom_alias == link.custom_alias).first()
-        if existing:
-            raise ValueError("custom_alias уже используется.")
-        short_code = link.custom_alias
-    else:
-        short_code = generate_short_code(settings.LINK_CODE_LENGTH)
-        while db.query(models.Link).filter(models.Link.short_code == short_code).first():
-            short_code = generate_short_code(settings.LINK_CODE_LENGTH)
-    
-    db_link = models.Link(
-        original_url=link.original_url,
-        short_code=short_code,
-        custom_alias=link.custom_alias,
-        expires_at=link.expires_at,
-        owner_id=owner_id,
-        project=link.project
-    )
-    db.add(db_link)
-    db.commit()
-    db.refresh(db_link)
-    return db_link
+    # Один INSERT: сгенерированные коды не пересекаются, кастомный alias проверяет уникальный индекс
+    collided = False
+    for _ in range(CODE_ALLOCATION_ATTEMPTS):
+        short_code = link.custom_alias or next_short_code(db, collided)
+        db_link = models.Link(
+            original_url=link.original_url,
+            original_url_hash=url_hash(link.original_url),
+            short_code=short_code,
+            custom_alias=link.custom_alias,
+            expires_at=link.expires_at,
+            owner_id=owner_id,
+            project=link.project,
+            redirect_status=link.redirect_status,
+            exact_clicks=link.exact_clicks
+        )
+        db.add(db_link)
+        add_codes([short_code])
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            if link.custom_alias:
+                raise ValueError("custom_alias уже используется.")
+            # Сгенерированный код уже занят (чужой alias или повторно выданный номер) – номерам
+            # этого блока верить нельзя, арендуем новый
+            collided = True
+            continue
+        db.refresh(db_link)
+        # Сбрасываем возможную отрицательную запись кэша для этого кода и результат поиска по URL
+        delete_cached_link(short_code)
+        delete_cached_search(db_link.original_url_hash)
+        mark_recent_writes(recent_write_keys(short_code, owner_id, db_link.original_url_hash))
+        publish_link_changes({short_code: link_to_cache(db_link)})
+        schedule_expiry({short_code: db_link.expires_at})
+        return db_link
+    raise ValueError("Не удалось подобрать свободный короткий код.")
 
 def get_link_by_code(db: Session, code: str):
     return db.query(models.Link).filter(models.Link.short_code == code).first()
 
-def update_link(db: Session, db_link: models.Link, link_update: schemas.LinkUpdate):
-    if link_update.expires_at:
-        db_link.expires_at = link_update.expires_at
-    db.commit()
-    db.refresh(db_link)
-    return db_link
-
 def delete_link(db: Session, db_link: models.Link):
+    short_code = db_link.short_code
+    original_url_hash = db_link.original_url_hash
+    owner_id = db_link.owner_id
     db.delete(db_link)
     db.commit()
+    delete_cached_link(short_code, deleted=True)
+    delete_cached_search(original_url_hash)
+    purge_links([short_code])
+    mark_recent_writes(recent_write_keys(short_code, owner_id, original_url_hash))
+    publish_link_changes(deletes=[short_code])
+
+def flush_redirect_counts(db: Session):
+    batch = take_pending_clicks()
+    if batch is None:
+        return 0
+    counts, lasts = batch
+    rows = [
+        {
+            "b_code": code,
+            "b_delta": int(delta),
+            "b_last": datetime.datetime.fromisoformat(lasts[code]) if code in lasts else datetime.datetime.utcnow(),
+        }
+        for code, delta in counts.items()
+    ]
+    try:
+        if rows:
+            stmt = (
+                update(models.Link)
+                .where(models.Link.short_code == bindparam("b_code"))
+                .values(
+                    redirect_count=models.Link.redirect_count + bindparam("b_delta"),
+                    last_accessed_at=bindparam("b_last"),
+                )
+            )
+            for shard_id, shard_rows in split_by_shard(rows, lambda row: row["b_code"]).items():
+                db.execute(stmt, shard_rows, bind_arguments=shard_bind(shard_id))
+            db.commit()
+    except Exception:
+        db.rollback()
+        release_clicks_lock()
+        raise
+    ack_pending_clicks()
+    record_hot_links(counts)
+    return sum(row["b_delta"] for row in rows)
 
-def increment_redirect_count(db: Session, db_link: models.Link):
-    db_link.redirect_count += 1
-    db_link.last_accessed_at = datetime.datetime.utcnow()
+def get_link_stats(db: Session, db_link: models.Link):
+    # Статистика с учётом кликов, ещё не сброшенных в БД
+    pending, pending_last = get_pending_clicks(db_link.short_code)
+    return build_link_stats(db_link, pending, pending_last)
+
+def build_link_stats(db_link: models.Link, pending: int, pending_last: datetime.datetime = None):
+    last_accessed_at = db_link.last_accessed_at
+    if pending_last and (last_accessed_at is None or pending_last > last_accessed_at):
+        last_accessed_at = pending_last
+    return schemas.LinkStats(
+        original_url=db_link.original_url,
+        created_at=db_link.created_at,
+        last_accessed_at=last_accessed_at,
+        redirect_count=(db_link.redirect_count or 0) + pending
+    )
+
+def upsert_click_rollups(db: Session, rollups):
+    # rollups: {(short_code, bucket, bucket_start, referrer, ua_class, country): clicks}
+    table = models.LinkClickRollup.__table__
+    dialect_insert = postgresql.insert if db.get_bind().dialect.name == "postgresql" else sqlite.insert
+    rows = [
+        {
+            "short_code": short_code, "bucket": bucket, "bucket_start": start,
+            "referrer": referrer, "ua_class": ua_class, "country": country, "clicks": clicks,
+        }
+        for (short_code, bucket, start, referrer, ua_class, country), clicks in rollups.items()
+    ]
+    for i in range(0, len(rows), ROLLUP_BATCH_SIZE):
+        stmt = dialect_insert(table).values(rows[i:i + ROLLUP_BATCH_SIZE])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["short_code", "bucket", "bucket_start", "referrer", "ua_class", "country"],
+            set_={"clicks": table.c.clicks + stmt.excluded.clicks},
+        )
+        db.execute(stmt)
     db.commit()
-    db.refresh(db_link)
-    return db_link
 
 def search_link_by_original(db: Session, original_url: str):
-    return db.query(models.Link).filter(models.Link.original_url == original_url).first()
+    # Поиск по индексу хэша нормализованного URL; результат (в т.ч. отрицательный) кэшируется в Redis
+    hashed = url_hash(original_url)
+    cached = get_cached_search(hashed)
+    if cached is not None:
+        return schemas.LinkOut.parse_raw(cached) if cached != "null" else None
+    db_link = first_by_id(db.query(models.Link).filter(models.Link.original_url_hash == hashed).order_by(models.Link.id).limit(1).all())
+    result = schemas.LinkOut.from_orm(db_link) if db_link else None
+    set_cached_search(hashed, result.json() if result else "null")
+    return result
 
 def record_expired_link(db: Session, db_link: models.Link):
     expired = models.ExpiredLink(
@@ -81,37 +189,154 @@ def record_expired_link(db: Session, db_link: models.Link):
     db.add(expired)
     db.commit()
 
+ARCHIVE_COLUMNS = ["link_id", "original_url", "short_code", "owner_id", "project", "deleted_at"]
+
+def _archive_links(db: Session, shard_id, ids, condition):
+    Link = models.Link
+    archived = select(
+        Link.id, Link.original_url, Link.short_code, Link.owner_id, Link.project,
+        literal(datetime.datetime.utcnow(), DateTime)
+    ).where(Link.id.in_(ids), condition)
+    if shard_id is None:
+        db.execute(insert(models.ExpiredLink).from_select(ARCHIVE_COLUMNS, archived))
+        return
+    # Архив в основной БД фиксируется до удаления из шарда: при сбое ссылка останется, а не пропадёт
+    rows = db.execute(on_shard(archived, shard_id)).all()
+    if rows:
+        db.execute(insert(models.ExpiredLink), [dict(zip(ARCHIVE_COLUMNS, row)) for row in rows])
+        db.commit()
+
+def archive_and_delete_links(db: Session, condition, batch_size: int = None, pause: float = None):
+    # Пачками по ключу id: INSERT INTO expired_links SELECT ... и DELETE одним запросом на пачку,
+    # короткие транзакции и пауза между пачками, чтобы не мешать основной нагрузке.
+    # Шарды links обходятся по очереди
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    pause = settings.CLEANUP_BATCH_PAUSE if pause is None else pause
+    return sum(_archive_and_delete_shard(db, shard_id, condition, batch_size, pause) for shard_id in query_shards())
+
+def _archive_and_delete_shard(db: Session, shard_id, condition, batch_size: int, pause: float):
+    Link = models.Link
+    total = 0
+    last_id = 0
+    while True:
+        query = db.query(Link.id, Link.short_code, Link.original_url_hash).filter(condition, Link.id > last_id)
+        batch = on_shard(query.order_by(Link.id).limit(batch_size), shard_id).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+        ids = [row.id for row in batch]
+        _archive_links(db, shard_id, ids, condition)
+        deleted = db.execute(
+            on_shard(delete(Link).where(Link.id.in_(ids), condition), shard_id).execution_options(synchronize_session=False)
+        )
+        db.commit()
+        codes = [row.short_code for row in batch]
+        delete_cached_links(codes, [row.original_url_hash for row in batch])
+        purge_links(codes)
+        if deleted.rowcount != len(batch):
+            # Часть ссылок перестала подходить под условие между выборкой и удалением – они остаются
+            remaining = {code for (code,) in db.query(Link.short_code).filter(Link.short_code.in_(codes))}
+            codes = [code for code in codes if code not in remaining]
+        publish_link_changes(deletes=codes)
+        total += deleted.rowcount
+        if len(batch) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return total
+
 def delete_expired_links(db: Session):
     now = datetime.datetime.utcnow()
-    expired_links = db.query(models.Link).filter(models.Link.expires_at != None, models.Link.expires_at < now).all()
-    count = 0
-    for link in expired_links:
-        record_expired_link(db, link)
-        db.delete(link)
-        count += 1
-    db.commit()
-    return count
+    return archive_and_delete_links(db, and_(models.Link.expires_at != None, models.Link.expires_at < now))
+
+def delete_due_links(db: Session, batch_size: int = None):
+    # Ссылки из очереди истечения, срок которых наступил: архивируются через секунды после expires_at.
+    # Условие проверяется по БД, поэтому продлённые и уже удалённые ссылки просто снимаются с очереди
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    total = 0
+    while True:
+        codes = due_expiries(batch_size)
+        if not codes:
+            break
+        now = datetime.datetime.utcnow()
+        condition = and_(models.Link.short_code.in_(codes), models.Link.expires_at != None, models.Link.expires_at < now)
+        total += archive_and_delete_links(db, condition, batch_size, pause=0)
+        ack_expiries(codes)
+        if len(codes) < batch_size:
+            break
+    return total
 
 def delete_unused_links(db: Session, inactive_days: int):
-    from datetime import timedelta
-    cutoff = datetime.datetime.utcnow() - timedelta(days=inactive_days)
-    unused_links = db.query(models.Link).filter(models.Link.last_accessed_at != None,
-                                                  models.Link.last_accessed_at < cutoff).all()
-    count = 0
-    for link in unused_links:
-        record_expired_link(db, link)
-        db.delete(link)
-        count += 1
-    db.commit()
-    return count
-
-def get_expired_links_by_user(db: Session, owner_id: int):
-    return db.query(models.ExpiredLink).filter(models.ExpiredLink.owner_id == owner_id).all()
-
-def get_links_grouped_by_project(db: Session, owner_id: int):
-    links = db.query(models.Link).filter(models.Link.owner_id == owner_id).all()
-    projects = {}
-    for link in links:
-        proj = link.project if link.project else "Без проекта"
-        projects.setdefault(proj, []).append(link)
-    return projects
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=inactive_days)
+    return archive_and_delete_links(db, and_(models.Link.last_accessed_at != None, models.Link.last_accessed_at < cutoff))
+
+def first_by_id(rows):
+    # Первая по id из строк, собранных со всех шардов (каждый вернул свою первую)
+    return min(rows, key=lambda row: row.id, default=None)
+
+def _page(rows, limit: int):
+    # Запрашиваем на одну строку больше: по ней видно, есть ли следующая страница
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, rows[-1].id
+    return rows, None
+
+def get_expired_links_by_user(db: Session, owner_id: int, before_id: int = None, limit: int = None):
+    # Сначала недавно удалённые; курсор – id последней показанной записи
+    limit = limit or settings.PAGE_SIZE
+    query = db.query(models.ExpiredLink).filter(models.ExpiredLink.owner_id == owner_id)
+    if before_id:
+        query = query.filter(models.ExpiredLink.id < before_id)
+    return _page(query.order_by(models.ExpiredLink.id.desc()).limit(limit + 1).all(), limit)
+
+def get_project_counts(db: Session, owner_id: int):
+    # Группировка на стороне БД: по строке на проект, ссылки не загружаются.
+    # Пустая строка и NULL – одна группа «без проекта»
+    Link = models.Link
+    project = func.nullif(Link.project, "")
+    rows = (
+        db.query(project.label("project"), func.count(Link.id).label("count"))
+        .filter(Link.owner_id == owner_id)
+        .group_by(project)
+        .order_by(project)
+        .all()
+    )
+    if not sharding_enabled:
+        return rows
+    # Один проект встречается в нескольких шардах – складываем; «без проекта» первым
+    counts = Counter()
+    for name, count in rows:
+        counts[name] += count
+    return sorted(counts.items(), key=lambda item: (item[0] is not None, item[0] or ""))
+
+LINK_PAGE_COLUMNS = (
+    models.Link.id, models.Link.short_code, models.Link.original_url,
+    models.Link.created_at, models.Link.expires_at, models.Link.project,
+    models.Link.redirect_status, models.Link.exact_clicks,
+)
+
+def get_project_links_page(db: Session, owner_id: int, project: str = None, after_id: int = None, limit: int = None):
+    # Пустой project – ссылки без проекта. Обход по индексу (owner_id, project, id)
+    limit = limit or settings.PAGE_SIZE
+    Link = models.Link
+    query = db.query(*LINK_PAGE_COLUMNS).filter(
+        Link.owner_id == owner_id, Link.project == project if project else or_(Link.project.is_(None), Link.project == "")
+    )
+    if after_id:
+        query = query.filter(Link.id > after_id)
+    rows = query.order_by(Link.id).limit(limit + 1).all()
+    if sharding_enabled:
+        # С каждого шарда приходит до limit + 1 строк – берём общие первые по id
+        rows = sorted(rows, key=lambda row: row.id)
+    return _page(rows, limit)
+
+def iter_owner_links(db: Session, owner_id: int, chunk_size: int = None):
+    # Все ссылки владельца по проектам, пачками: в памяти не больше одной пачки
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    for project, _ in get_project_counts(db, owner_id):
+        after_id = None
+        while True:
+            rows, after_id = get_project_links_page(db, owner_id, project, after_id, chunk_size)
+            yield from rows
+            if after_id is None:
+                break
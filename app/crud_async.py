@@ -0,0 +1,218 @@
+import datetime
+from sqlalchemy import func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models, schemas
+from app.crud import build_link_stats, first_by_id, CODE_ALLOCATION_ATTEMPTS
+from app.utils import url_hash
+from app.security import hash_password_async
+from app.bloom import add_codes_async
+from app.snapshot import publish_link_changes_async
+from app.sharding import shard_bind, split_by_shard
+from app.shortcodes import next_short_code_async, next_short_codes_async
+from app.caching import (
+    delete_cached_link_async, delete_cached_search_async, record_click_async, get_pending_clicks_async,
+    set_cached_links_async, cache_entry, link_to_cache, invalidate_identity, mark_recent_writes_async, recent_write_keys,
+    schedule_expiry_async
+)
+
+# Асинхронные варианты запросов для горячих путей (перенаправление, создание, статистика)
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    hashed_password = await hash_password_async(user.password)
+    db_user = models.User(username=user.username, hashed_password=hashed_password)
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    invalidate_identity(db_user.username)
+    return db_user
+
+async def update_password_hash(db: AsyncSession, db_user: models.User, hashed_password: str):
+    db_user.hashed_password = hashed_password
+    await db.commit()
+    invalidate_identity(db_user.username)
+
+async def get_link_by_code(db: AsyncSession, code: str):
+    result = await db.execute(select(models.Link).where(models.Link.short_code == code))
+    return result.scalars().first()
+
+async def get_links_by_codes(db: AsyncSession, codes):
+    Link = models.Link
+    result = await db.execute(
+        select(Link.short_code, Link.original_url, Link.expires_at, Link.redirect_status, Link.exact_clicks).where(Link.short_code.in_(codes))
+    )
+    return result.all()
+
+async def create_link(db: AsyncSession, link: schemas.LinkCreate, owner_id: int = None):
+    collided = False
+    for _ in range(CODE_ALLOCATION_ATTEMPTS):
+        short_code = link.custom_alias or await next_short_code_async(db, collided)
+        db_link = models.Link(
+            original_url=str(link.original_url),
+            original_url_hash=url_hash(link.original_url),
+            short_code=short_code,
+            custom_alias=link.custom_alias,
+            expires_at=link.expires_at,
+            owner_id=owner_id,
+            project=link.project,
+            redirect_status=link.redirect_status,
+            exact_clicks=link.exact_clicks
+        )
+        db.add(db_link)
+        await add_codes_async([short_code])
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            if link.custom_alias:
+                raise ValueError("custom_alias уже используется.")
+            collided = True
+            continue
+        await db.refresh(db_link)
+        await delete_cached_link_async(short_code)
+        await delete_cached_search_async(db_link.original_url_hash)
+        await mark_recent_writes_async(recent_write_keys(short_code, owner_id, db_link.original_url_hash))
+        await publish_link_changes_async({short_code: link_to_cache(db_link)})
+        await schedule_expiry_async({short_code: db_link.expires_at})
+        return db_link
+    raise ValueError("Не удалось подобрать свободный короткий код.")
+
+async def create_links_bulk(db: AsyncSession, items, owner_id: int = None):
+    # items – список пар (index, LinkCreate); возвращает LinkBatchItemResult по каждому элементу
+    results = {}
+    aliases = [link.custom_alias for _, link in items if link.custom_alias]
+    taken = set()
+    if aliases:
+        rows = await db.execute(select(models.Link.short_code).where(models.Link.short_code.in_(aliases)))
+        taken = set(rows.scalars())
+    pending = []
+    for index, link in items:
+        if link.custom_alias:
+            if link.custom_alias in taken:
+                results[index] = schemas.LinkBatchItemResult(index=index, error="custom_alias уже используется.")
+                continue
+            taken.add(link.custom_alias)
+        pending.append((index, link))
+
+    codes = iter(await next_short_codes_async(db, sum(1 for _, link in pending if not link.custom_alias)))
+    now = datetime.datetime.utcnow()
+    rows = []
+    for index, link in pending:
+        rows.append({
+            "original_url": str(link.original_url),
+            "original_url_hash": url_hash(link.original_url),
+            "short_code": link.custom_alias or next(codes),
+            "custom_alias": link.custom_alias,
+            "created_at": now,
+            "expires_at": link.expires_at,
+            "redirect_count": 0,
+            "owner_id": owner_id,
+            "project": link.project,
+            "redirect_status": link.redirect_status,
+            "exact_clicks": link.exact_clicks,
+        })
+
+    try:
+        if rows:
+            await add_codes_async([row["short_code"] for row in rows])
+            for shard_id, shard_rows in split_by_shard(rows, lambda row: row["short_code"], current_only=True).items():
+                await db.execute(insert(models.Link).values(shard_rows), bind_arguments=shard_bind(shard_id))
+            await db.commit()
+        created = rows
+    except IntegrityError:
+        await db.rollback()
+        # Конфликт с параллельной вставкой – вставляем по одной, чтобы выяснить, какие элементы не прошли
+        created = []
+        for (index, link), row in zip(pending, rows):
+            try:
+                db_link = await create_link(db, link, owner_id=owner_id)
+            except ValueError as ve:
+                results[index] = schemas.LinkBatchItemResult(index=index, error=str(ve))
+                continue
+            row["short_code"] = db_link.short_code
+            created.append(row)
+        pending = [(index, link) for index, link in pending if index not in results]
+
+    for (index, link), row in zip(pending, created):
+        results[index] = schemas.LinkBatchItemResult(index=index, short_code=row["short_code"], original_url=row["original_url"])
+    entries = {
+        row["short_code"]: cache_entry(row["original_url"], row["expires_at"], row["redirect_status"], row["exact_clicks"])
+        for row in created
+    }
+    await set_cached_links_async(
+        entries,
+        invalidate=[row["short_code"] for row in created if row["custom_alias"]],
+        search_hashes={row["original_url_hash"] for row in created},
+    )
+    if created:
+        await mark_recent_writes_async(
+            [key for row in created for key in recent_write_keys(row["short_code"], url_hash=row["original_url_hash"])]
+            + recent_write_keys(owner_id=owner_id)
+        )
+        await publish_link_changes_async(entries)
+        await schedule_expiry_async({row["short_code"]: row["expires_at"] for row in created})
+    return [results[index] for index, _ in items]
+
+async def find_owned_link_by_url(db: AsyncSession, link: schemas.LinkCreate, owner_id: int):
+    # Для режима дедупликации: действующая ссылка того же владельца на тот же (нормализованный) URL
+    # с теми же сроком жизни, проектом и параметрами перенаправления
+    now = datetime.datetime.utcnow()
+    Link = models.Link
+    result = await db.execute(
+        select(Link)
+        .where(
+            Link.original_url_hash == url_hash(link.original_url),
+            Link.owner_id == owner_id,
+            Link.expires_at == link.expires_at,
+            or_(Link.expires_at == None, Link.expires_at > now),
+            Link.project == link.project,
+            Link.redirect_status == link.redirect_status,
+            func.coalesce(Link.exact_clicks, False) == link.exact_clicks,
+        )
+        .order_by(Link.id)
+        .limit(1)
+    )
+    return first_by_id(result.scalars().all())
+
+async def get_link_timeseries(db: AsyncSession, short_code: str, bucket: str, start: datetime.datetime, end: datetime.datetime):
+    Rollup = models.LinkClickRollup
+    window = (Rollup.short_code == short_code, Rollup.bucket == bucket, Rollup.bucket_start >= start, Rollup.bucket_start <= end)
+    points = await db.execute(
+        select(Rollup.bucket_start, func.sum(Rollup.clicks))
+        .where(*window)
+        .group_by(Rollup.bucket_start)
+        .order_by(Rollup.bucket_start)
+    )
+    breakdowns = {}
+    for name, column in (("referrers", Rollup.referrer), ("user_agents", Rollup.ua_class), ("countries", Rollup.country)):
+        rows = await db.execute(select(column, func.sum(Rollup.clicks)).where(*window).group_by(column))
+        breakdowns[name] = {key: int(clicks) for key, clicks in rows}
+    return schemas.LinkTimeseries(
+        short_code=short_code,
+        bucket=bucket,
+        points=[schemas.TimeseriesPoint(bucket_start=moment, clicks=int(clicks)) for moment, clicks in points],
+        **breakdowns
+    )
+
+async def increment_redirect_count_by_code(db: AsyncSession, code: str):
+    await db.execute(
+        update(models.Link)
+        .where(models.Link.short_code == code)
+        .values(
+            redirect_count=models.Link.redirect_count + 1,
+            last_accessed_at=datetime.datetime.utcnow(),
+        )
+    )
+    await db.commit()
+
+async def register_redirect(db: AsyncSession, code: str):
+    if not await record_click_async(code, datetime.datetime.utcnow()):
+        await increment_redirect_count_by_code(db, code)
+
+async def get_link_stats(db: AsyncSession, db_link: models.Link):
+    pending, pending_last = await get_pending_clicks_async(db_link.short_code)
+    return build_link_stats(db_link, pending, pending_last)
@@ -1,15 +1,299 @@
-from sqlalchemy import create_engine
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
+from app.caching import has_recent_write, has_recent_write_async
+from app import sharding
 
-engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True)
+class PoolMetrics:
+    # Счётчики выдачи соединений из пула: сколько ждали, сколько раз упёрлись в таймаут
+    # и сколько выдач пришлось на соединения сверх pool_size
+    def __init__(self):
+        self.checkouts = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, wait: float, overflow: bool):
+        with self._lock:
+            self.checkouts += 1
+            self.overflow_checkouts += overflow
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "overflow_checkouts": self.overflow_checkouts,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+def _instrumented_pool(pool_class, metrics: PoolMetrics):
+    class InstrumentedPool(pool_class):
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except exc.TimeoutError:
+                metrics.timed_out()
+                raise
+            metrics.observe(time.perf_counter() - started, self.overflow() > 0)
+            return connection
+    return InstrumentedPool
+
+pool_metrics = {"sync": PoolMetrics(), "async": PoolMetrics()}
+
+def engine_options(url: str, pool_class, metrics: PoolMetrics) -> dict:
+    options = {"pool_pre_ping": settings.DB_POOL_PRE_PING}
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        # У SQLite свои пулы без настроек размера
+        return options
+    if settings.DB_PGBOUNCER and url.get_driver_name() == "asyncpg":
+        options["connect_args"] = {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+    if settings.DB_POOL_CLASS == "null":
+        options["poolclass"] = NullPool
+        return options
+    options.update(
+        poolclass=_instrumented_pool(pool_class, metrics),
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+    )
+    return options
+
+engine = create_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL, QueuePool, pool_metrics["sync"]))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def to_async_url(database_url: str) -> str:
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    return str(url.set(drivername=ASYNC_DRIVERS.get(backend, url.drivername)))
+
+def get_async_database_url() -> str:
+    if settings.ASYNC_DATABASE_URL:
+        return settings.ASYNC_DATABASE_URL
+    return to_async_url(settings.DATABASE_URL)
+
+# Асинхронный движок для горячих путей (перенаправление, создание, статистика)
+async_engine = create_async_engine(
+    get_async_database_url(),
+    **engine_options(get_async_database_url(), AsyncAdaptedQueuePool, pool_metrics["async"]),
+)
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Движки шардов links; основная БД – шард PRIMARY
+shard_engines = {sharding.PRIMARY: engine}
+shard_async_engines = {sharding.PRIMARY: async_engine}
+for shard_id, shard_url in sharding.shard_urls.items():
+    if shard_id == sharding.PRIMARY:
+        continue
+    pool_metrics[f"shard{shard_id}-sync"] = PoolMetrics()
+    pool_metrics[f"shard{shard_id}-async"] = PoolMetrics()
+    shard_engines[shard_id] = create_engine(
+        shard_url, **engine_options(shard_url, QueuePool, pool_metrics[f"shard{shard_id}-sync"])
+    )
+    shard_async_url = to_async_url(shard_url)
+    shard_async_engines[shard_id] = create_async_engine(
+        shard_async_url, **engine_options(shard_async_url, AsyncAdaptedQueuePool, pool_metrics[f"shard{shard_id}-async"])
+    )
+
+if sharding.sharding_enabled:
+    # Сессии сами направляют запросы к links в шард по коду или во все шарды сразу (см. app/sharding.py)
+    from sqlalchemy.ext.horizontal_shard import ShardedSession
+    SHARD_CHOOSERS = {
+        "shard_chooser": sharding.shard_chooser,
+        "id_chooser": sharding.id_chooser,
+        "execute_chooser": sharding.execute_chooser,
+    }
+    SessionLocal = sessionmaker(
+        class_=ShardedSession, autocommit=False, autoflush=False, shards=shard_engines, **SHARD_CHOOSERS
+    )
+    AsyncSessionLocal = sessionmaker(
+        class_=AsyncSession,
+        sync_session_class=ShardedSession,
+        autoflush=False,
+        expire_on_commit=False,
+        shards={shard_id: async_shard.sync_engine for shard_id, async_shard in shard_async_engines.items()},
+        **SHARD_CHOOSERS,
+    )
+
+class Replica:
+    # Реплика для чтения: синхронный и асинхронный движки и признак доступности.
+    # Обрыв соединения сразу исключает реплику, вернуть её может только проверка здоровья
+    def __init__(self, name: str, url: str):
+        self.name = name
+        pool_metrics[f"{name}-sync"] = PoolMetrics()
+        pool_metrics[f"{name}-async"] = PoolMetrics()
+        self.engine = create_engine(url, **engine_options(url, QueuePool, pool_metrics[f"{name}-sync"]))
+        async_url = to_async_url(url)
+        self.async_engine = create_async_engine(
+            async_url, **engine_options(async_url, AsyncAdaptedQueuePool, pool_metrics[f"{name}-async"])
+        )
+        self.healthy = True
+        self.lag = None
+        self.last_error = None
+        event.listen(self.engine, "handle_error", self._on_error)
+        event.listen(self.async_engine.sync_engine, "handle_error", self._on_error)
+
+    def _on_error(self, context):
+        if context.is_disconnect:
+            self.mark_down(str(context.original_exception))
+
+    def mark_down(self, error: str):
+        if self.healthy:
+            print(f"Реплика {self.name} исключена: {error}")
+        self.healthy = False
+        self.last_error = error
+
+    def check(self):
+        try:
+            with self.engine.connect() as conn:
+                if self.engine.dialect.name == "postgresql":
+                    self.lag = conn.execute(text(
+                        "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+                    )).scalar()
+                else:
+                    conn.execute(text("SELECT 1"))
+        except Exception as e:
+            self.mark_down(str(e))
+            return
+        if self.lag is not None and self.lag > settings.REPLICA_MAX_LAG:
+            self.mark_down(f"отставание {self.lag:.1f} с")
+            return
+        self.healthy = True
+        self.last_error = None
+
+    def stats(self) -> dict:
+        return {"healthy": self.healthy, "lag": self.lag, "last_error": self.last_error}
+
+# Реплики описаны для одной основной БД, а ссылки при шардировании лежат в других базах, поэтому
+# шардирование и реплики взаимоисключающие. Один шард – сама основная БД – шардированием не считается
+if sharding.sharding_enabled and settings.DATABASE_READ_URLS.strip():
+    print("DATABASE_READ_URLS не используется: при шардировании links (DATABASE_SHARD_URLS) все чтения идут в шарды")
+if settings.DATABASE_READ_URLS.strip() and not sharding.sharding_enabled and (
+    settings.READ_YOUR_WRITES_SECONDS < settings.REPLICA_MAX_LAG + settings.REPLICA_HEALTH_CHECK_INTERVAL
+):
+    raise RuntimeError(
+        "READ_YOUR_WRITES_SECONDS должен быть не меньше REPLICA_MAX_LAG + REPLICA_HEALTH_CHECK_INTERVAL: "
+        "иначе отстающая реплика заполнит кэш удалённой или изменённой ссылкой"
+    )
+replicas = [] if sharding.sharding_enabled else [
+    Replica(f"replica{index}", url.strip())
+    for index, url in enumerate(settings.DATABASE_READ_URLS.split(","))
+    if url.strip()
+]
+_replica_counter = itertools.count()
+
+def pick_replica():
+    # По кругу среди доступных реплик; если доступных нет – None, то есть основная БД
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        return None
+    return healthy[next(_replica_counter) % len(healthy)]
+
+@contextmanager
+def read_session(recent_keys=()):
+    # Сессия только для чтения: реплика, если по ключам не было недавней записи
+    replica = None
+    if replicas and not (recent_keys and has_recent_write(recent_keys)):
+        replica = pick_replica()
+    db = SessionLocal(bind=replica.engine) if replica else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+@asynccontextmanager
+async def async_read_session(recent_keys=()):
+    replica = None
+    if replicas and not (recent_keys and await has_recent_write_async(recent_keys)):
+        replica = pick_replica()
+    async with (AsyncSessionLocal(bind=replica.async_engine) if replica else AsyncSessionLocal()) as db:
+        yield db
+
+async def get_async_read_db():
+    async with async_read_session() as db:
+        yield db
+
+_health_stop = threading.Event()
+
+def _health_loop():
+    while not _health_stop.wait(settings.REPLICA_HEALTH_CHECK_INTERVAL):
+        for replica in replicas:
+            replica.check()
+
+def start_replica_health_checks():
+    if not replicas:
+        return
+    _health_stop.clear()
+    threading.Thread(target=_health_loop, name="replica-health", daemon=True).start()
+
+def stop_replica_health_checks():
+    _health_stop.set()
+
+def replicas_stats() -> dict:
+    return {replica.name: replica.stats() for replica in replicas}
+
+def _pool_state(pool) -> dict:
+    state = {"pooled": isinstance(pool, QueuePool)}
+    if isinstance(pool, QueuePool):
+        state.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+        )
+    return state
+
+def pool_stats() -> dict:
+    stats = {
+        "sync": {**_pool_state(engine.pool), **pool_metrics["sync"].stats()},
+        "async": {**_pool_state(async_engine.pool), **pool_metrics["async"].stats()},
+    }
+    for shard_id in shard_engines:
+        if shard_id != sharding.PRIMARY:
+            stats[f"shard{shard_id}-sync"] = {**_pool_state(shard_engines[shard_id].pool), **pool_metrics[f"shard{shard_id}-sync"].stats()}
+            stats[f"shard{shard_id}-async"] = {
+                **_pool_state(shard_async_engines[shard_id].pool), **pool_metrics[f"shard{shard_id}-async"].stats()
+            }
+    for replica in replicas:
+        stats[f"{replica.name}-sync"] = {**_pool_state(replica.engine.pool), **pool_metrics[f"{replica.name}-sync"].stats()}
+        stats[f"{replica.name}-async"] = {
+            **_pool_state(replica.async_engine.pool), **pool_metrics[f"{replica.name}-async"].stats()
+        }
+    return stats
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
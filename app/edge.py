@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+from collections import Counter
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, status
+from fastapi.responses import JSONResponse, RedirectResponse, Response
+from app.analytics import record_click_event, start_analytics_flusher, stop_analytics_flusher
+from app.caching import record_clicks_async
+from app.cdn import redirect_headers, redirect_status
+from app.config import settings
+from app.metrics import MetricsMiddleware, render_metrics
+from app.snapshot import current_snapshot
+
+# Парк перенаправлений: только GET/HEAD /links/{short_code} по снимку ссылок (app/snapshot.py).
+# Ни Postgres, ни Redis на пути запроса нет; переходы копятся в процессе и сбрасываются в Redis в фоне.
+#   python -m app.snapshot follow &
+#   uvicorn app.edge:app --workers 8
+
+class ClickBuffer:
+    def __init__(self):
+        self.counts = Counter()
+        self.lasts = {}
+
+    def add(self, short_code: str, accessed_at: datetime.datetime):
+        self.counts[short_code] += 1
+        self.lasts[short_code] = accessed_at
+
+    async def flush(self):
+        if not self.counts:
+            return
+        counts, lasts = self.counts, self.lasts
+        self.counts, self.lasts = Counter(), {}
+        if not await record_clicks_async(counts, lasts):
+            # Redis недоступен – возвращаем переходы в буфер до следующей попытки
+            self.counts.update(counts)
+            for short_code, accessed_at in lasts.items():
+                self.lasts.setdefault(short_code, accessed_at)
+
+clicks = ClickBuffer()
+
+async def _flush_clicks_loop():
+    while True:
+        await asyncio.sleep(settings.EDGE_CLICK_FLUSH_INTERVAL)
+        await clicks.flush()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    current_snapshot()
+    flush_task = asyncio.create_task(_flush_clicks_loop())
+    start_analytics_flusher()
+    yield
+    flush_task.cancel()
+    await clicks.flush()
+    stop_analytics_flusher()
+
+app = FastAPI(
+    title="URL Shortener Redirects",
+    docs_url=None,
+    redoc_url=None,
+    openapi_url=None,
+    lifespan=lifespan
+)
+
+app.add_middleware(MetricsMiddleware)
+
+@app.api_route("/links/{short_code}", methods=["GET", "HEAD"])
+async def redirect_link(short_code: str, request: Request):
+    # Те же ответы, что у основного сервиса: 404, 410 для устаревших, код и заголовки кэширования ссылки
+    snapshot = current_snapshot()
+    if snapshot is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Снимок ссылок ещё не загружен.")
+    cached = snapshot.lookup(short_code)
+    if cached is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ссылка не найдена.")
+    now = datetime.datetime.utcnow()
+    if cached["expires_at"] and datetime.datetime.fromisoformat(cached["expires_at"]) < now:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Ссылка устарела.")
+    if request.method != "HEAD":
+        clicks.add(short_code, now)
+        headers = request.headers
+        record_click_event(
+            short_code, headers.get("referer"), headers.get("user-agent"), headers.get(settings.ANALYTICS_COUNTRY_HEADER)
+        )
+    return RedirectResponse(
+        url=cached["original_url"],
+        status_code=redirect_status(cached),
+        headers=redirect_headers(short_code, cached, now),
+    )
+
+@app.get("/health/live", include_in_schema=False)
+def health_live():
+    return {"status": "ok"}
+
+@app.get("/health/ready", include_in_schema=False)
+async def health_ready():
+    # Как и перенаправление, выполняется в event loop: снимок не закрывается из другого потока
+    snapshot = current_snapshot()
+    return JSONResponse(
+        status_code=200 if snapshot else 503,
+        content={"ready": snapshot is not None, "snapshot": snapshot.stats() if snapshot else None},
+    )
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
@@ -1,11 +1,40 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from app.routers import links, users, frontend
-from app.database import engine, Base
-from app.tasks import schedule_cleanup_task
+from app.database import pool_stats, replicas_stats, start_replica_health_checks, stop_replica_health_checks
+from app.tasks import start_scheduler, stop_scheduler, jobs_stats
+from app.config import settings
+from app.security import PasswordHashingBusy, shutdown_executor
+from app.metrics import MetricsMiddleware, render_metrics
+from app.analytics import start_analytics_flusher, stop_analytics_flusher
+from app.caching import fill_stats, local_cache, redis_cache_stats, redis_pool_stats, start_invalidation_listener
+from app.bloom import filter_stats
+from app.warmup import state as warmup_state, warm_up
 
-Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Схема по умолчанию создаётся отдельным шагом (python -m app.migrations), а не каждым воркером
+    if settings.MIGRATE_ON_STARTUP:
+        from app.migrations import migrate_all
+        await run_in_threadpool(migrate_all)
+    # Прогрев идёт в фоне: о его завершении сообщает /health/ready
+    warmup_task = asyncio.create_task(warm_up())
+    start_invalidation_listener()
+    start_replica_health_checks()
+    start_analytics_flusher()
+    if settings.RUN_SCHEDULER_IN_WEB:
+        start_scheduler()
+    yield
+    warmup_task.cancel()
+    if settings.RUN_SCHEDULER_IN_WEB:
+        stop_scheduler()
+    stop_analytics_flusher()
+    stop_replica_health_checks()
+    shutdown_executor()
 
 app = FastAPI(
     title="URL Shortener Service",
@@ -13,7 +42,8 @@ app = FastAPI(
     version="1.0.0",
     docs_url=None,
     redoc_url=None,
-    openapi_url=None
+    openapi_url=None,
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -24,14 +54,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(links.router, prefix="/links", tags=["links"])
 app.include_router(users.router, prefix="/users", tags=["users"])
 app.include_router(frontend.router, prefix="/ui", tags=["UI"])
 
+@app.exception_handler(PasswordHashingBusy)
+async def password_hashing_busy_handler(request: Request, exc: PasswordHashingBusy):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
 @app.get("/", response_class=HTMLResponse, include_in_schema=False)
 def root(request: Request):
     return frontend.ui_index(request)
 
-@app.on_event("startup")
-async def startup_event():
-    schedule_cleanup_task()
+@app.get("/cache/stats", include_in_schema=False)
+def cache_stats():
+    return {"local": local_cache.stats(), "redis": dict(redis_cache_stats), "fills": dict(fill_stats), "bloom": filter_stats()}
+
+@app.get("/health/live", include_in_schema=False)
+def health_live():
+    return {"status": "ok"}
+
+@app.get("/health/ready", include_in_schema=False)
+def health_ready():
+    return JSONResponse(status_code=200 if warmup_state["ready"] else 503, content=warmup_state)
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+@app.get("/pool/stats", include_in_schema=False)
+def pools_stats():
+    return {"database": pool_stats(), "replicas": replicas_stats(), "redis": redis_pool_stats()}
+
+@app.get("/tasks/stats", include_in_schema=False)
+def tasks_stats():
+    return jobs_stats()
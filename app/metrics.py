@@ -0,0 +1,195 @@
+from bisect import bisect_left
+from time import perf_counter
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from sqlalchemy import event
+from app.bloom import bloom_stats
+from app.caching import fill_stats, identity_cache, local_cache, redis_cache_stats, redis_pool_stats
+from app.database import async_engine, engine, pool_stats, shard_async_engines, shard_engines
+
+# Границы корзин рассчитаны на перенаправление: большинство запросов укладывается в миллисекунды
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+class LoopHistogram:
+    # Гистограмма для кода, работающего только в event loop: без блокировок, наблюдение –
+    # один bisect и два сложения (Histogram из prometheus_client берёт блокировку на каждое значение)
+    def __init__(self, buckets):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def metric(self, family: HistogramMetricFamily, labels):
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            buckets.append((str(bound) if bound != float("inf") else "+Inf", total))
+        family.add_metric(labels, buckets, self.sum)
+
+# Метка route – шаблон пути (/links/{short_code}), а не конкретный код, чтобы не плодить ряды
+request_latency = {}
+redirect_stages = {stage: LoopHistogram(STAGE_BUCKETS) for stage in ("cache", "db", "counter", "response")}
+
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "Время выполнения запросов к БД", ["engine", "operation"], buckets=LATENCY_BUCKETS,
+)
+JOB_DURATION = Histogram(
+    "job_duration_seconds", "Длительность фоновых задач", ["job"],
+    buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0),
+)
+JOB_ROWS = Counter("job_rows", "Строки, обработанные фоновыми задачами", ["job"])
+JOB_RUNS = Counter("job_runs", "Запуски фоновых задач", ["job", "result"])
+
+def observe_request(method: str, route: str, status_code: int, duration: float):
+    key = (method, route, status_code)
+    histogram = request_latency.get(key)
+    if histogram is None:
+        histogram = request_latency[key] = LoopHistogram(LATENCY_BUCKETS)
+    histogram.observe(duration)
+
+def observe_job(job: str, duration: float, rows):
+    JOB_DURATION.labels(job).observe(duration)
+    JOB_RUNS.labels(job, "success").inc()
+    if rows:
+        JOB_ROWS.labels(job).inc(rows)
+
+class MetricsMiddleware:
+    # Чистый ASGI-слой без BaseHTTPMiddleware: лишней задачи и копирования тела ответа нет
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    def _route(self, scope) -> str:
+        if self._routes is None:
+            self._routes = {
+                route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")
+            }
+        return self._routes.get(scope.get("endpoint"), "<unmatched>")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            observe_request(scope["method"], self._route(scope), status_code, perf_counter() - started)
+
+def _operation(statement: str) -> str:
+    operation = statement[:6].upper()
+    return operation if operation in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER"
+
+_query_children = {}
+
+def _observe_query(name: str, statement: str, duration: float):
+    key = (name, _operation(statement.lstrip()))
+    child = _query_children.get(key)
+    if child is None:
+        child = _query_children[key] = DB_QUERY_LATENCY.labels(*key)
+    child.observe(duration)
+
+def instrument_engine(sync_engine, name: str):
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_started = perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_started", None)
+        if started is not None:
+            _observe_query(name, statement, perf_counter() - started)
+
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
+for _shard_id, _shard_engine in shard_engines.items():
+    if _shard_engine is not engine:
+        instrument_engine(_shard_engine, f"shard{_shard_id}-sync")
+        instrument_engine(shard_async_engines[_shard_id].sync_engine, f"shard{_shard_id}-async")
+
+class StateCollector:
+    # Значения, которые и так считаются в приложении (кэши, пулы, гистограммы event loop),
+    # читаются только в момент опроса
+    def collect(self):
+        requests = HistogramMetricFamily(
+            "http_request_duration_seconds", "Время обработки запроса", labels=["method", "route", "status"]
+        )
+        for (method, route, status_code), histogram in list(request_latency.items()):
+            histogram.metric(requests, [method, route, str(status_code)])
+        yield requests
+
+        stages = HistogramMetricFamily("redirect_stage_duration_seconds", "Время этапов перенаправления", labels=["stage"])
+        for stage, histogram in redirect_stages.items():
+            histogram.metric(stages, [stage])
+        yield stages
+
+        cache_requests = CounterMetricFamily("cache_requests", "Обращения к кэшам", labels=["cache", "result"])
+        for name, cache in (("local", local_cache), ("identity", identity_cache)):
+            stats = cache.stats()
+            cache_requests.add_metric([name, "hit"], stats["hits"])
+            cache_requests.add_metric([name, "miss"], stats["misses"])
+        for result, key in (("hit", "hits"), ("miss", "misses"), ("error", "errors")):
+            cache_requests.add_metric(["redis", result], redis_cache_stats[key])
+        yield cache_requests
+
+        # Защита от лавины промахов: fills – загрузки из БД, coalesced – запросы, дождавшиеся загрузки
+        # в том же процессе, lock_* – ожидание загрузки другим воркером, stale/refreshes – отдача устаревших записей
+        cache_fills = CounterMetricFamily("cache_fill_events", "Заполнение кэша ссылок из БД", labels=["event"])
+        for event_name in (
+            "fills", "coalesced", "lock_waits", "lock_served", "lock_timeouts", "stale", "refreshes", "refresh_errors",
+            "tombstoned",
+        ):
+            cache_fills.add_metric([event_name], fill_stats[event_name])
+        yield cache_fills
+
+        bloom = CounterMetricFamily("bloom_checks", "Проверки кодов фильтром Блума", labels=["result"])
+        bloom.add_metric(["rejected"], bloom_stats["rejected"])
+        bloom.add_metric(["passed"], bloom_stats["checks"] - bloom_stats["rejected"])
+        bloom.add_metric(["dirty"], bloom_stats["dirty"])
+        yield bloom
+
+        cache_size = GaugeMetricFamily("local_cache_entries", "Записей в локальных кэшах", labels=["cache"])
+        cache_size.add_metric(["local"], local_cache.stats()["size"])
+        cache_size.add_metric(["identity"], identity_cache.stats()["size"])
+        yield cache_size
+
+        db_pool = GaugeMetricFamily("db_pool_connections", "Соединения пула БД", labels=["engine", "state"])
+        db_checkouts = CounterMetricFamily("db_pool_checkouts", "Выдачи соединений из пула БД", labels=["engine", "kind"])
+        db_wait = GaugeMetricFamily("db_pool_wait_max_seconds", "Максимальное ожидание соединения", labels=["engine"])
+        for name, stats in pool_stats().items():
+            for state in ("checked_out", "checked_in", "overflow"):
+                if state in stats:
+                    db_pool.add_metric([name, state], stats[state])
+            db_checkouts.add_metric([name, "all"], stats["checkouts"])
+            db_checkouts.add_metric([name, "overflow"], stats["overflow_checkouts"])
+            db_checkouts.add_metric([name, "timeout"], stats["timeouts"])
+            db_wait.add_metric([name], stats["wait_max_ms"] / 1000)
+        yield db_pool
+        yield db_checkouts
+        yield db_wait
+
+        redis_pool = GaugeMetricFamily("redis_pool_connections", "Соединения пула Redis", labels=["client", "state"])
+        for name, stats in redis_pool_stats().items():
+            for state in ("in_use", "idle"):
+                if state in stats:
+                    redis_pool.add_metric([name, state], stats[state])
+        yield redis_pool
+
+REGISTRY.register(StateCollector())
+
+def render_metrics():
+    # Метрики относятся к одному процессу; при нескольких воркерах опрашивайте каждый отдельно
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,108 @@
+import time
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import Base
+from app import models
+from app.sharding import SHARD_ID_STRIDE, link_shards, sharding_enabled
+from app.utils import url_hash
+
+# Колонки, добавленные после первого релиза: create_all не меняет уже существующие таблицы
+ADDED_COLUMNS = [
+    models.Link.__table__.c.original_url_hash,
+    models.Link.__table__.c.redirect_status,
+    models.Link.__table__.c.exact_clicks,
+]
+
+BACKFILL_BATCH_SIZE = 1000
+
+def add_missing_columns(engine):
+    inspector = inspect(engine)
+    for column in ADDED_COLUMNS:
+        table = column.table
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        if column.name in existing:
+            continue
+        column_type = column.type.compile(dialect=engine.dialect)
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+def create_missing_indexes(engine):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+def backfill_url_hashes(engine):
+    # Заполняем хэши для ссылок, созданных до появления колонки
+    Link = models.Link
+    total = 0
+    with Session(engine) as db:
+        while True:
+            rows = db.query(Link.id, Link.original_url).filter(Link.original_url_hash == None).limit(BACKFILL_BATCH_SIZE).all()
+            if not rows:
+                break
+            db.bulk_update_mappings(Link, [{"id": row.id, "original_url_hash": url_hash(row.original_url)} for row in rows])
+            db.commit()
+            total += len(rows)
+    return total
+
+def prepare_link_shard(engine, shard_id: str):
+    # Пользователи живут только в основной БД, поэтому внешний ключ links.owner_id в шарде снимается.
+    # Последовательность id шарда идёт с шагом SHARD_ID_STRIDE и своим остатком – id уникальны между шардами
+    if engine.dialect.name != "postgresql":
+        return
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for foreign_key in inspector.get_foreign_keys("links"):
+            conn.execute(text(f'ALTER TABLE links DROP CONSTRAINT "{foreign_key["name"]}"'))
+        increment = conn.execute(text("SELECT increment_by FROM pg_sequences WHERE sequencename = 'links_id_seq'")).scalar()
+        if increment == SHARD_ID_STRIDE:
+            return
+        # Новые id начинаются выше всех существующих, в том числе перенесённых из других шардов
+        start = (conn.execute(text("SELECT coalesce(max(id), 0) FROM links")).scalar() // SHARD_ID_STRIDE + 1) * SHARD_ID_STRIDE
+        conn.execute(text(
+            f"ALTER SEQUENCE links_id_seq INCREMENT BY {SHARD_ID_STRIDE} RESTART WITH {start + int(shard_id)}"
+        ))
+
+def sync_code_sequence(engine):
+    # Шаг последовательности номеров задаётся при её создании; после смены CODE_BLOCK_SIZE он приводится
+    # к настройке, а счёт продолжается за последним выданным блоком, чтобы блоки не пересеклись
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        row = conn.execute(text(
+            "SELECT increment_by, last_value FROM pg_sequences WHERE sequencename = 'link_code_seq'"
+        )).first()
+        if row is None or row.increment_by == settings.CODE_BLOCK_SIZE:
+            return
+        restart = "" if row.last_value is None else f" RESTART WITH {row.last_value + row.increment_by}"
+        conn.execute(text(f"ALTER SEQUENCE link_code_seq INCREMENT BY {settings.CODE_BLOCK_SIZE}{restart}"))
+
+def run_migrations(engine):
+    Base.metadata.create_all(bind=engine)
+    sync_code_sequence(engine)
+    add_missing_columns(engine)
+    create_missing_indexes(engine)
+    backfill_url_hashes(engine)
+
+def migrate_all():
+    # Основная БД и все шарды links (DATABASE_SHARD_URLS и DATABASE_SHARD_URLS_PREVIOUS)
+    from app.database import engine, shard_engines
+    run_migrations(engine)
+    if not sharding_enabled:
+        return
+    for shard_id in link_shards:
+        shard_engine = shard_engines[shard_id]
+        if shard_engine is not engine:
+            run_migrations(shard_engine)
+        prepare_link_shard(shard_engine, shard_id)
+
+def main():
+    # Схема создаётся и обновляется отдельным шагом перед запуском воркеров:
+    #   python -m app.migrations
+    started = time.monotonic()
+    migrate_all()
+    print(f"Миграции выполнены за {time.monotonic() - started:.2f} с")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import Boolean, Column, Integer, SmallInteger, String, DateTime, ForeignKey, Text, Sequence, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from app.database import Base
+from app.config import settings
+
+# Последовательность для выдачи блоков номеров коротких кодов (CODE_ID_SOURCE=postgres)
+link_code_seq = Sequence("link_code_seq", increment=settings.CODE_BLOCK_SIZE, metadata=Base.metadata)
 
 class User(Base):
     __tablename__ = "users"
@@ -15,22 +19,36 @@ class User(Base):
 
 class Link(Base):
     __tablename__ = "links"
+    # Группировка по проектам владельца и постраничный обход проекта по id
+    __table_args__ = (
+        Index("ix_links_owner_project_id", "owner_id", "project", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     original_url = Column(Text, nullable=False)
+    # SHA-256 нормализованного URL для индексированного обратного поиска
+    original_url_hash = Column(String(64), index=True, nullable=True)
     short_code = Column(String(20), unique=True, index=True, nullable=False)
     custom_alias = Column(String(50), unique=True, index=True, nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
-    expires_at = Column(DateTime, nullable=True)
-    last_accessed_at = Column(DateTime, nullable=True)
+    # Индексы для очистки просроченных и неиспользуемых ссылок без полного прохода по таблице
+    expires_at = Column(DateTime, nullable=True, index=True)
+    last_accessed_at = Column(DateTime, nullable=True, index=True)
     redirect_count = Column(Integer, default=0)
     owner_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     project = Column(String(100), nullable=True)  # поле для указания проекта
+    # Код ответа перенаправления (301/302/307/308); NULL – REDIRECT_STATUS из настроек
+    redirect_status = Column(SmallInteger, nullable=True)
+    # Точный подсчёт переходов: ответ не кэшируется ни браузером, ни CDN
+    exact_clicks = Column(Boolean, nullable=True, default=False)
     
     owner = relationship("User", back_populates="links")
 
 class ExpiredLink(Base):
     __tablename__ = "expired_links"
+    __table_args__ = (
+        Index("ix_expired_links_owner_id_id", "owner_id", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     link_id = Column(Integer, nullable=False)
@@ -39,3 +57,20 @@ class ExpiredLink(Base):
     owner_id = Column(Integer, nullable=True)
     project = Column(String(100), nullable=True)
     deleted_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class LinkClickRollup(Base):
+    # Агрегаты переходов по корзинам времени (minute/hour/day) с разбивкой
+    # по домену источника, классу user-agent и стране
+    __tablename__ = "link_click_rollups"
+    __table_args__ = (
+        UniqueConstraint("short_code", "bucket", "bucket_start", "referrer", "ua_class", "country", name="uq_link_click_rollup"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    short_code = Column(String(20), nullable=False)
+    bucket = Column(String(10), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    referrer = Column(String(100), nullable=False)
+    ua_class = Column(String(20), nullable=False)
+    country = Column(String(8), nullable=False)
+    clicks = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,78 @@
+import gzip
+import hashlib
+from types import SimpleNamespace
+import brotli
+from fastapi import Request
+from fastapi.responses import Response
+from app.config import settings
+
+_templates = None
+
+def get_templates():
+    # Jinja2 загружается при первом рендере (или прогреве), а не при импорте приложения
+    global _templates
+    if _templates is None:
+        from fastapi.templating import Jinja2Templates
+        templates = Jinja2Templates(directory="templates")
+        # Скомпилированные шаблоны и так кэшируются Jinja2; без auto_reload он ещё и не проверяет mtime файла на каждый рендер
+        templates.env.auto_reload = settings.UI_TEMPLATE_AUTO_RELOAD
+        _templates = templates
+    return _templates
+
+NO_CACHE = "private, no-cache"
+
+def _etag(body: bytes) -> str:
+    # Слабый ETag: одинаков для всех вариантов сжатия одного и того же содержимого
+    return 'W/"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+def _not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+def _accepted_encoding(request: Request):
+    header = request.headers.get("accept-encoding", "")
+    encodings = {part.split(";")[0].strip() for part in header.split(",")}
+    if "br" in encodings:
+        return "br"
+    if "gzip" in encodings:
+        return "gzip"
+    return None
+
+class StaticPage:
+    # Страница, отрисованная один раз при старте: готовые байты, ETag и заранее сжатые варианты
+    def __init__(self, body: bytes, cache_control: str, vary: str = "Accept-Encoding"):
+        self.etag = _etag(body)
+        self.cache_control = cache_control
+        self.vary = vary
+        self.bodies = {
+            None: body,
+            "gzip": gzip.compress(body, compresslevel=9),
+            "br": brotli.compress(body, mode=brotli.MODE_TEXT),
+        }
+
+    def response(self, request: Request) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": self.cache_control, "Vary": self.vary}
+        if _not_modified(request, self.etag):
+            return Response(status_code=304, headers=headers)
+        encoding = _accepted_encoding(request)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(self.bodies[encoding], media_type="text/html", headers=headers)
+
+def prerender(name: str, cookies: dict = None, cache_control: str = None, vary: str = "Accept-Encoding") -> StaticPage:
+    # Статические формы не обращаются к запросу, кроме cookies на главной – их подставляем явно
+    request = SimpleNamespace(cookies=cookies or {})
+    body = get_templates().get_template(name).render(request=request).encode()
+    return StaticPage(body, cache_control or f"public, max-age={settings.UI_CACHE_MAX_AGE}", vary)
+
+def render_page(request: Request, name: str, context: dict, status_code: int = 200) -> Response:
+    # Динамическая страница: рендер из скомпилированного шаблона и условный GET по ETag содержимого
+    body = get_templates().get_template(name).render(request=request, **context).encode()
+    etag = _etag(body)
+    headers = {"ETag": etag, "Cache-Control": NO_CACHE}
+    if status_code == 200 and _not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, status_code=status_code, media_type="text/html", headers=headers)
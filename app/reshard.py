@@ -0,0 +1,97 @@
+import argparse
+import time
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from app import models
+from app.config import settings
+from app.database import shard_engines
+from app.sharding import current_layout, link_shards, previous_layout, shard_for
+
+# Перенос ссылок между шардами после изменения DATABASE_SHARD_URLS. Порядок:
+#   1. DATABASE_SHARD_URLS_PREVIOUS = прежний список, DATABASE_SHARD_URLS = новый
+#   2. python -m app.migrations – схема в новых шардах
+#   3. выкатка: новые ссылки пишутся по новой раскладке, поиск идёт в обоих шардах
+#   4. python -m app.reshard migrate
+#   5. DATABASE_SHARD_URLS_PREVIOUS убирается, выкатка
+
+def _move_batch(source: Session, target: Session, rows) -> int:
+    Link = models.Link
+    columns = [column.name for column in Link.__table__.columns]
+    values = [dict(zip(columns, row)) for row in rows]
+    if target.get_bind().dialect.name != "postgresql":
+        # id уникальны между шардами только в Postgres (см. app/migrations.py)
+        for value in values:
+            value.pop("id")
+    dialect_insert = postgresql.insert if target.get_bind().dialect.name == "postgresql" else sqlite.insert
+    # Ссылка уже могла попасть в целевой шард при прерванном прошлом запуске
+    target.execute(dialect_insert(Link).values(values).on_conflict_do_nothing(index_elements=[Link.short_code]))
+    target.commit()
+    source.execute(delete(Link).where(Link.id.in_([row.id for row in rows])))
+    return len(rows)
+
+def migrate_shard(source_id: str, batch_size: int = None, pause: float = None) -> int:
+    # Строки выбираются с блокировкой: до удаления из исходного шарда их никто не изменит
+    batch_size = batch_size or settings.RESHARD_BATCH_SIZE
+    pause = settings.CLEANUP_BATCH_PAUSE if pause is None else pause
+    Link = models.Link
+    targets = {}
+    moved = 0
+    last_id = 0
+    with Session(shard_engines[source_id]) as source:
+        try:
+            while True:
+                rows = source.execute(
+                    select(*Link.__table__.columns).where(Link.id > last_id).order_by(Link.id).limit(batch_size).with_for_update()
+                ).all()
+                if not rows:
+                    source.commit()
+                    break
+                last_id = rows[-1].id
+                by_target = {}
+                for row in rows:
+                    target_id = shard_for(row.short_code)
+                    if target_id != source_id:
+                        by_target.setdefault(target_id, []).append(row)
+                for target_id, target_rows in by_target.items():
+                    if target_id not in targets:
+                        targets[target_id] = Session(shard_engines[target_id])
+                    moved += _move_batch(source, targets[target_id], target_rows)
+                source.commit()
+                if len(rows) < batch_size:
+                    break
+                if by_target and pause:
+                    time.sleep(pause)
+        finally:
+            for target in targets.values():
+                target.close()
+    return moved
+
+def shard_counts():
+    counts = {}
+    for shard_id in link_shards:
+        with Session(shard_engines[shard_id]) as db:
+            counts[shard_id] = db.execute(select(func.count(models.Link.id))).scalar()
+    return counts
+
+def main():
+    #   python -m app.reshard migrate   – перенести ссылки в шарды по новой раскладке
+    #   python -m app.reshard status    – число ссылок в каждом шарде
+    parser = argparse.ArgumentParser(description="Перешардирование таблицы links")
+    parser.add_argument("command", choices=("migrate", "status"))
+    parser.add_argument("--batch-size", type=int, default=settings.RESHARD_BATCH_SIZE)
+    args = parser.parse_args()
+    if args.command == "status":
+        for shard_id, count in shard_counts().items():
+            role = "текущий" if shard_id in current_layout else "прежний"
+            print(f"Шард {shard_id} ({role}): {count} ссылок")
+        return
+    if not previous_layout:
+        print("DATABASE_SHARD_URLS_PREVIOUS не задан: ссылки и так лежат по текущей раскладке")
+    for shard_id in link_shards:
+        started = time.monotonic()
+        moved = migrate_shard(shard_id, args.batch_size)
+        print(f"Шард {shard_id}: перенесено {moved} ссылок за {time.monotonic() - started:.2f} с")
+
+if __name__ == "__main__":
+    main()
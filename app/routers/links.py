@@ -1,36 +1,263 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Header
-from fastapi.responses import RedirectResponse
+import csv
+import io
+import json
+import tempfile
+from time import perf_counter
+from datetime import timedelta
+from functools import partial
+from fastapi import APIRouter, Depends, HTTPException, status, Header, Request, Query
+from fastapi.responses import RedirectResponse, StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime
-from app import schemas, crud
-from app.database import get_db
-from app.routers.users import get_current_user
-from app.caching import delete_cached_link
+from app import schemas, crud, crud_async
+from app.database import get_db, get_async_db, get_async_read_db, read_session, async_read_session
+from app.config import settings
+from app.analytics import record_click_event
+from app.bloom import might_exist_async
+from app.cdn import redirect_headers, redirect_status
+from app.metrics import redirect_stages
+from app.utils import url_hash, to_naive_utc
+from app.routers.users import get_current_user, get_current_user_async
+from app.caching import (
+    get_cached_link_async, fill_cached_link_async, set_missing_link_async, link_to_cache, recent_write_keys,
+    LINK_MISSING, LINK_EXPIRED
+)
 
 router = APIRouter()
 
 @router.post("/shorten", response_model=schemas.LinkOut, summary="Создание короткой ссылки")
-def create_short_link(link: schemas.LinkCreate, db: Session = Depends(get_db), token: str = Header(None)):
+async def create_short_link(
+    link: schemas.LinkCreate,
+    dedup: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+    token: str = Header(None)
+):
     owner_id = None
     if token:
-        user = get_current_user(token, db)
+        user = await get_current_user_async(token, db)
         if user:
             owner_id = user.id
+    # Режим дедупликации: тот же владелец уже сокращал этот URL с теми же параметрами – возвращаем
+    # существующий код. Анонимные ссылки не переиспользуются: иначе пользователи получали бы чужие ссылки
+    if dedup and owner_id is not None and not link.custom_alias:
+        existing = await crud_async.find_owned_link_by_url(db, link, owner_id=owner_id)
+        if existing:
+            return existing
     try:
-        db_link = crud.create_link(db, link, owner_id=owner_id)
+        db_link = await crud_async.create_link(db, link, owner_id=owner_id)
     except ValueError as ve:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(ve))
     return db_link
 
-@router.get("/{short_code}", summary="Перенаправление по короткой ссылке")
-def redirect_link(short_code: str, db: Session = Depends(get_db)):
-    db_link = crud.get_link_by_code(db, short_code)
+def _parse_batch_item(index: int, item):
+    try:
+        if isinstance(item, (bytes, str)):
+            item = json.loads(item)
+        return schemas.LinkCreate.parse_obj(item), None
+    except (ValueError, ValidationError) as e:
+        return None, schemas.LinkBatchItemResult(index=index, error=str(e))
+
+async def _create_batch_chunk(db: AsyncSession, chunk, owner_id):
+    if not chunk:
+        return []
+    return await crud_async.create_links_bulk(db, chunk, owner_id=owner_id)
+
+async def _process_ndjson_batch(request: Request, db: AsyncSession, owner_id):
+    # Построчно читаем тело, создаём ссылки пачками и пишем результаты во временный файл,
+    # чтобы расход памяти не зависел от размера пакета
+    out = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode="w+b")
+    chunk = []
+    index = 0
+    buffer = b""
+
+    def write(results):
+        for result in results:
+            out.write(result.json().encode() + b"\n")
+
+    async def handle(line: bytes):
+        nonlocal index, chunk
+        if not line.strip():
+            return
+        link, error = _parse_batch_item(index, line)
+        if error:
+            write([error])
+        else:
+            chunk.append((index, link))
+        index += 1
+        if len(chunk) >= settings.BATCH_CHUNK_SIZE:
+            write(await _create_batch_chunk(db, chunk, owner_id))
+            chunk = []
+
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            await handle(line)
+    await handle(buffer)
+    write(await _create_batch_chunk(db, chunk, owner_id))
+    out.seek(0)
+    return out
+
+def _iter_file(out):
+    try:
+        yield from out
+    finally:
+        out.close()
+
+@router.post("/shorten/batch", response_model=schemas.LinkBatchResult, summary="Пакетное создание коротких ссылок")
+async def create_short_links_batch(request: Request, db: AsyncSession = Depends(get_async_db), token: str = Header(None)):
+    owner_id = None
+    if token:
+        user = await get_current_user_async(token, db)
+        owner_id = user.id
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        out = await _process_ndjson_batch(request, db, owner_id)
+        return StreamingResponse(_iter_file(out), media_type="application/x-ndjson")
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный JSON.")
+    if not isinstance(payload, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Ожидается список ссылок.")
+    if len(payload) > settings.BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Не более {settings.BATCH_MAX_ITEMS} ссылок за запрос; для больших пакетов используйте application/x-ndjson."
+        )
+    results = []
+    chunk = []
+    for index, item in enumerate(payload):
+        link, error = _parse_batch_item(index, item)
+        if error:
+            results.append(error)
+            continue
+        chunk.append((index, link))
+        if len(chunk) >= settings.BATCH_CHUNK_SIZE:
+            results.extend(await _create_batch_chunk(db, chunk, owner_id))
+            chunk = []
+    results.extend(await _create_batch_chunk(db, chunk, owner_id))
+    results.sort(key=lambda r: r.index)
+    failed = sum(1 for r in results if r.error)
+    return schemas.LinkBatchResult(created=len(results) - failed, failed=failed, results=results)
+
+@router.get("/search", response_model=schemas.LinkOut, summary="Поиск ссылки по оригинальному URL")
+def search_link(original_url: str):
+    # Сразу после создания ссылки на этот URL читаем из основной БД, иначе кэш поиска запомнит промах реплики
+    with read_session(recent_write_keys(url_hash=url_hash(original_url))) as db:
+        db_link = crud.search_link_by_original(db, original_url)
     if not db_link:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ссылка не найдена.")
-    if db_link.expires_at and db_link.expires_at < datetime.utcnow():
+    return db_link
+
+@router.get("/projects", response_model=schemas.ProjectList, summary="Проекты пользователя с числом ссылок")
+def get_projects(db: Session = Depends(get_db), token: str = Header(...)):
+    current_user = get_current_user(token, db)
+    with read_session(recent_write_keys(owner_id=current_user.id)) as read_db:
+        counts = crud.get_project_counts(read_db, current_user.id)
+    return {"projects": [{"project": project, "count": count} for project, count in counts]}
+
+@router.get("/projects/links", response_model=schemas.LinkPage, summary="Ссылки проекта постранично")
+def get_project_links(
+    project: str = Query(None),
+    cursor: int = Query(None),
+    limit: int = Query(None, ge=1, le=settings.PAGE_MAX_SIZE),
+    db: Session = Depends(get_db),
+    token: str = Header(...)
+):
+    # Без project – ссылки без проекта; следующую страницу запрашивать с cursor=next_cursor
+    current_user = get_current_user(token, db)
+    with read_session(recent_write_keys(owner_id=current_user.id)) as read_db:
+        items, next_cursor = crud.get_project_links_page(read_db, current_user.id, project, cursor, limit)
+        return {"items": items, "next_cursor": next_cursor}
+
+EXPORT_FIELDS = ("project", "short_code", "original_url", "created_at", "expires_at")
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def _iter_export(owner_id: int, export_format: str):
+    # Строки собираются пачками: один yield на EXPORT_CHUNK_SIZE ссылок
+    with read_session(recent_write_keys(owner_id=owner_id)) as db:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == "csv":
+            writer.writerow(EXPORT_FIELDS)
+        count = 0
+        for row in crud.iter_owner_links(db, owner_id):
+            values = [_export_value(getattr(row, field)) for field in EXPORT_FIELDS]
+            if export_format == "csv":
+                writer.writerow(values)
+            else:
+                buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, values)), ensure_ascii=False) + "\n")
+            count += 1
+            if count % settings.EXPORT_CHUNK_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+@router.get("/projects/export", summary="Выгрузка всех ссылок пользователя (NDJSON или CSV)")
+def export_project_links(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    db: Session = Depends(get_db),
+    token: str = Header(...)
+):
+    current_user = get_current_user(token, db)
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        _iter_export(current_user.id, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="links.{format}"'},
+    )
+
+async def _load_link(short_code: str):
+    # Запись кэша по данным БД; None – ссылки нет
+    async with async_read_session(recent_write_keys(short_code)) as read_db:
+        db_link = await crud_async.get_link_by_code(read_db, short_code)
+    return link_to_cache(db_link) if db_link else None
+
+@router.api_route("/{short_code}", methods=["GET", "HEAD"], summary="Перенаправление по короткой ссылке")
+async def redirect_link(short_code: str, request: Request, db: AsyncSession = Depends(get_async_db)):
+    # Сначала Redis, при промахе – БД с заполнением кэша (в т.ч. отрицательного).
+    # Одновременные промахи по одному коду ждут одной загрузки, устаревшая запись обновляется в фоне
+    started = perf_counter()
+    load = partial(_load_link, short_code)
+    cached = await get_cached_link_async(short_code, refresh=load)
+    checkpoint = perf_counter()
+    redirect_stages["cache"].observe(checkpoint - started)
+    if cached is None:
+        # Кода точно нет по фильтру Блума – отвечаем сразу, без БД и без записи в отрицательный кэш
+        if not await might_exist_async(short_code):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ссылка не найдена.")
+        cached = await fill_cached_link_async(short_code, load)
+        started, checkpoint = checkpoint, perf_counter()
+        redirect_stages["db"].observe(checkpoint - started)
+    if cached.get("status") == LINK_MISSING:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ссылка не найдена.")
+    if cached.get("status") == LINK_EXPIRED:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Ссылка устарела.")
+    now = datetime.utcnow()
+    if cached["expires_at"] and datetime.fromisoformat(cached["expires_at"]) < now:
+        await set_missing_link_async(short_code, LINK_EXPIRED)
         raise HTTPException(status_code=status.HTTP_410_GONE, detail="Ссылка устарела.")
-    db_link = crud.increment_redirect_count(db, db_link)
-    return RedirectResponse(url=db_link.original_url)
+    # HEAD (проверки ссылок, предзагрузка) получает те же заголовки, но переходом не считается
+    if request.method != "HEAD":
+        await crud_async.register_redirect(db, short_code)
+        headers = request.headers
+        record_click_event(
+            short_code, headers.get("referer"), headers.get("user-agent"), headers.get(settings.ANALYTICS_COUNTRY_HEADER)
+        )
+    started, checkpoint = checkpoint, perf_counter()
+    redirect_stages["counter"].observe(checkpoint - started)
+    response = RedirectResponse(
+        url=cached["original_url"],
+        status_code=redirect_status(cached),
+        headers=redirect_headers(short_code, cached, now),
+    )
+    redirect_stages["response"].observe(perf_counter() - checkpoint)
+    return response
 
 @router.delete("/{short_code}", summary="Удаление ссылки")
 def delete_short_link(short_code: str, db: Session = Depends(get_db), token: str = Header(...)):
@@ -42,7 +269,6 @@ def delete_short_link(short_code: str, db: Session = Depends(get_db), token: str
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Нет доступа для удаления этой ссылки.")
     crud.record_expired_link(db, db_link)
     crud.delete_link(db, db_link)
-    delete_cached_link(short_code)
     return {"detail": f"Ссылка {short_code} успешно удалена."}
 
 @router.put("/{short_code}", response_model=schemas.LinkOut, summary="Обновление ссылки")
@@ -58,36 +284,38 @@ def update_short_link(short_code: str, link_update: schemas.LinkUpdate, db: Sess
         original_url=db_link.original_url,
         expires_at=link_update.expires_at,
         custom_alias=db_link.custom_alias,
-        project=db_link.project
+        project=db_link.project,
+        redirect_status=link_update.redirect_status or db_link.redirect_status,
+        exact_clicks=bool(db_link.exact_clicks) if link_update.exact_clicks is None else link_update.exact_clicks
     )
     new_db_link = crud.create_link(db, new_link_data, owner_id=current_user.id)
     crud.record_expired_link(db, db_link)
     crud.delete_link(db, db_link)
-    delete_cached_link(short_code)
     return new_db_link
 
 @router.get("/{short_code}/stats", response_model=schemas.LinkStats, summary="Статистика по ссылке")
-def get_link_stats(short_code: str, db: Session = Depends(get_db)):
-    db_link = crud.get_link_by_code(db, short_code)
-    if not db_link:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ссылка не найдена.")
-    stats = schemas.LinkStats(
-        original_url=db_link.original_url,
-        created_at=db_link.created_at,
-        last_accessed_at=db_link.last_accessed_at,
-        redirect_count=db_link.redirect_count
-    )
-    return stats
+async def get_link_stats(short_code: str):
+    async with async_read_session(recent_write_keys(short_code)) as db:
+        db_link = await crud_async.get_link_by_code(db, short_code)
+        if not db_link:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ссылка не найдена.")
+        return await crud_async.get_link_stats(db, db_link)
 
-@router.get("/search", response_model=schemas.LinkOut, summary="Поиск ссылки по оригинальному URL")
-def search_link(original_url: str, db: Session = Depends(get_db)):
-    db_link = crud.search_link_by_original(db, original_url)
-    if not db_link:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ссылка не найдена.")
-    return db_link
+BUCKET_SIZES = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
 
-@router.get("/projects", summary="Группировка ссылок по проектам", response_model=dict)
-def get_projects(db: Session = Depends(get_db), token: str = Header(...)):
-    current_user = get_current_user(token, db)
-    projects = crud.get_links_grouped_by_project(db, current_user.id)
-    return projects
+@router.get("/{short_code}/stats/timeseries", response_model=schemas.LinkTimeseries, summary="Переходы по интервалам времени")
+async def get_link_timeseries(
+    short_code: str,
+    from_: datetime = Query(None, alias="from"),
+    to: datetime = Query(None),
+    bucket: str = Query("hour", regex="^(minute|hour|day)$"),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    # Читается только из агрегатов; по умолчанию – последние сутки
+    end = to_naive_utc(to) or datetime.utcnow()
+    start = to_naive_utc(from_) or end - timedelta(days=1)
+    if start > end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Начало интервала позже конца.")
+    if (end - start) / BUCKET_SIZES[bucket] > settings.ANALYTICS_MAX_POINTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Слишком много точек; увеличьте bucket или сузьте интервал.")
+    return await crud_async.get_link_timeseries(db, short_code, bucket, start, end)
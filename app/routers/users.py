@@ -1,56 +1,86 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta, datetime
-from app import schemas, crud, models
-from app.database import get_db
+from app import schemas, crud, crud_async, models
+from app.database import get_async_db
 from app.config import settings
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+from app.caching import get_cached_identity, get_cached_identity_async, set_cached_identity, set_cached_identity_async
+from app.security import verify_password_async
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 
 router = APIRouter()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/login")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
+    # jose (с cryptography) импортируется при первом использовании, а не при старте воркера
+    from jose import jwt
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta if expires_delta else timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str, db: Session):
-    credentials_exception = HTTPException(
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Не удалось проверить учетные данные.",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def decode_token(token: str) -> schemas.TokenData:
+    from jose import JWTError, jwt
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(username=username)
+            raise _credentials_exception()
+        return schemas.TokenData(username=username)
     except JWTError:
-        raise credentials_exception
-    user = crud.get_user_by_username(db, username=token_data.username)
-    if user is None:
-        raise credentials_exception
-    return user
+        raise _credentials_exception()
+
+def get_current_user(token: str, db: Session):
+    # Проверенный пользователь из кэша; в БД идём только при промахе
+    token_data = decode_token(token)
+    identity = get_cached_identity(token_data.username)
+    if identity is None:
+        user = crud.get_user_by_username(db, username=token_data.username)
+        if user is None:
+            raise _credentials_exception()
+        identity = {"id": user.id, "username": user.username}
+        set_cached_identity(user.username, identity)
+    return schemas.UserIdentity(**identity)
+
+async def get_current_user_async(token: str, db: AsyncSession):
+    token_data = decode_token(token)
+    identity = await get_cached_identity_async(token_data.username)
+    if identity is None:
+        user = await crud_async.get_user_by_username(db, username=token_data.username)
+        if user is None:
+            raise _credentials_exception()
+        identity = {"id": user.id, "username": user.username}
+        await set_cached_identity_async(user.username, identity)
+    return schemas.UserIdentity(**identity)
 
 @router.post("/register", response_model=schemas.UserOut, summary="Регистрация пользователя")
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_username(db, username=user.username)
+async def register(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    db_user = await crud_async.get_user_by_username(db, username=user.username)
     if db_user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Пользователь с таким именем уже существует.")
-    new_user = crud.create_user(db, user)
+    new_user = await crud_async.create_user(db, user)
     return new_user
 
 @router.post("/login", response_model=schemas.Token, summary="Авторизация пользователя")
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.get_user_by_username(db, username=form_data.username)
-    if not user or not pwd_context.verify(form_data.password, user.hashed_password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    # bcrypt выполняется в отдельном пуле и не блокирует event loop
+    user = await crud_async.get_user_by_username(db, username=form_data.username)
+    if not user:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неверное имя пользователя или пароль.")
+    valid, new_hash = await verify_password_async(form_data.password, user.hashed_password)
+    if not valid:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Неверное имя пользователя или пароль.")
+    if new_hash:
+        await crud_async.update_password_hash(db, user, new_hash)
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
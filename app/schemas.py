@@ -1,6 +1,9 @@
 from datetime import datetime
-from typing import Optional
-from pydantic import BaseModel, AnyUrl
+from typing import Dict, List, Literal, Optional
+from pydantic import BaseModel, AnyUrl, validator
+from app.utils import to_naive_utc
+
+RedirectStatus = Literal[301, 302, 307, 308]
 
 class LinkBase(BaseModel):
     original_url: AnyUrl
@@ -9,10 +12,37 @@ class LinkCreate(LinkBase):
     custom_alias: Optional[str] = None
     expires_at: Optional[datetime] = None
     project: Optional[str] = None  # новый параметр
+    redirect_status: Optional[RedirectStatus] = None
+    exact_clicks: bool = False
+
+    _naive_expires_at = validator("expires_at", allow_reuse=True)(to_naive_utc)
+
+    class Config:
+        # Веб-интерфейс задаёт expires_at после создания модели
+        validate_assignment = True
+
+class LinkBatchItemResult(BaseModel):
+    index: int
+    short_code: Optional[str] = None
+    original_url: Optional[str] = None
+    error: Optional[str] = None
+
+class LinkBatchResult(BaseModel):
+    created: int
+    failed: int
+    results: List[LinkBatchItemResult]
 
 class LinkUpdate(BaseModel):
     # Обновление теперь применяется только к expires_at (обновление ссылки происходит путём перегенерации)
     expires_at: Optional[datetime] = None
+    # Режим перенаправления переносится на новую ссылку, если не задан явно
+    redirect_status: Optional[RedirectStatus] = None
+    exact_clicks: Optional[bool] = None
+
+    _naive_expires_at = validator("expires_at", allow_reuse=True)(to_naive_utc)
+
+    class Config:
+        validate_assignment = True
 
 class LinkStats(BaseModel):
     original_url: AnyUrl
@@ -20,16 +50,41 @@ class LinkStats(BaseModel):
     last_accessed_at: Optional[datetime] = None
     redirect_count: int
 
+class TimeseriesPoint(BaseModel):
+    bucket_start: datetime
+    clicks: int
+
+class LinkTimeseries(BaseModel):
+    short_code: str
+    bucket: str
+    points: List[TimeseriesPoint]
+    referrers: Dict[str, int]
+    user_agents: Dict[str, int]
+    countries: Dict[str, int]
+
 class LinkOut(BaseModel):
     short_code: str
     original_url: AnyUrl
     created_at: datetime
     expires_at: Optional[datetime] = None
     project: Optional[str] = None
+    redirect_status: Optional[int] = None
+    exact_clicks: Optional[bool] = False
 
     class Config:
         orm_mode = True
 
+class ProjectSummary(BaseModel):
+    project: Optional[str] = None
+    count: int
+
+class ProjectList(BaseModel):
+    projects: List[ProjectSummary]
+
+class LinkPage(BaseModel):
+    items: List[LinkOut]
+    next_cursor: Optional[int] = None
+
 class UserBase(BaseModel):
     username: str
 
@@ -43,6 +98,11 @@ class UserOut(UserBase):
     class Config:
         orm_mode = True
 
+class UserIdentity(BaseModel):
+    # Лёгкая запись о пользователе для авторизации без ORM-запроса
+    id: int
+    username: str
+
 class Token(BaseModel):
     access_token: str
     token_type: str
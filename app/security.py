@@ -0,0 +1,104 @@
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from app.config import settings
+
+_pwd_context = None
+
+def get_pwd_context():
+    # passlib и bcrypt импортируются при первом хэшировании: в режиме "process" это происходит
+    # только в процессах пула, а веб-воркер стартует без них
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        # Стоимость bcrypt задаётся в настройках; хэши с другой стоимостью считаются устаревшими
+        # и прозрачно пересчитываются при входе (verify_and_update)
+        _pwd_context = CryptContext(
+            schemes=["bcrypt"],
+            deprecated="auto",
+            bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+            bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+            bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+        )
+    return _pwd_context
+
+class PasswordHashingBusy(Exception):
+    # Очередь на хэширование паролей переполнена – запрос нужно отклонить сразу
+    pass
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = 0
+_pending_lock = threading.Lock()
+
+def _get_executor():
+    # Пул создаётся лениво, уже внутри воркера uvicorn
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                if settings.PASSWORD_EXECUTOR == "thread":
+                    _executor = ThreadPoolExecutor(max_workers=settings.PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+                else:
+                    _executor = ProcessPoolExecutor(
+                        max_workers=settings.PASSWORD_WORKERS,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+    return _executor
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def _hash(password: str) -> str:
+    return get_pwd_context().hash(password)
+
+def _verify_and_update(password: str, hashed_password: str):
+    return get_pwd_context().verify_and_update(password, hashed_password)
+
+def _load_context():
+    get_pwd_context()
+
+def warm_up_executor():
+    # Поднимаем процессы пула и загружаем в них passlib заранее, чтобы первый вход не ждал запуска
+    executor = _get_executor()
+    futures = [executor.submit(_load_context) for _ in range(settings.PASSWORD_WORKERS)]
+    for future in futures:
+        future.result()
+
+def _release(_future=None):
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+def _submit(func, *args):
+    # Допуск в очередь: не больше PASSWORD_MAX_PENDING задач в работе и ожидании
+    global _pending
+    with _pending_lock:
+        if _pending >= settings.PASSWORD_MAX_PENDING:
+            raise PasswordHashingBusy("Слишком много запросов авторизации, повторите попытку позже.")
+        _pending += 1
+    try:
+        future = _get_executor().submit(func, *args)
+    except Exception:
+        _release()
+        raise
+    future.add_done_callback(_release)
+    return future
+
+def hash_password(password: str) -> str:
+    return _submit(_hash, password).result()
+
+async def hash_password_async(password: str) -> str:
+    return await asyncio.wrap_future(_submit(_hash, password))
+
+def verify_password(password: str, hashed_password: str):
+    # Возвращает (пароль верен, новый хэш или None)
+    return _submit(_verify_and_update, password, hashed_password).result()
+
+async def verify_password_async(password: str, hashed_password: str):
+    return await asyncio.wrap_future(_submit(_verify_and_update, password, hashed_password))
@@ -0,0 +1,143 @@
+import hashlib
+from sqlalchemy import inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from app.config import settings
+
+# Горизонтальное шардирование таблицы links по хэшу short_code (DATABASE_SHARD_URLS).
+# Пользователи, архив удалённых ссылок и агрегаты переходов остаются в основной БД – шарде PRIMARY.
+# Шард кода выбирается jump consistent hash: при добавлении шарда в конец списка переезжает ~1/N ссылок.
+# Во время перешардирования (DATABASE_SHARD_URLS_PREVIOUS – прежний список) новые ссылки пишутся
+# по новой раскладке, а поиск по коду идёт в обоих шардах, пока app.reshard переносит строки.
+PRIMARY = "0"
+SHARDED_TABLES = {"links"}
+# id ссылок в шардах Postgres идут с этим шагом и своим остатком у каждого шарда, поэтому уникальны
+# между шардами и годятся для курсоров постраничного обхода
+SHARD_ID_STRIDE = 64
+
+def _urls(value: str):
+    return [url.strip() for url in value.split(",") if url.strip()]
+
+# Идентификатор шарда – номер URL в порядке появления; основная БД всегда PRIMARY
+shard_urls = {PRIMARY: settings.DATABASE_URL}
+
+def _same_database(first: str, second: str) -> bool:
+    # Один и тот же адрес с разными драйверами (postgresql:// и postgresql+psycopg2://) – одна база
+    first, second = make_url(first), make_url(second)
+    return first.set(drivername=first.get_backend_name()) == second.set(drivername=second.get_backend_name())
+
+def _shard_id(url: str) -> str:
+    for shard_id, known in shard_urls.items():
+        if _same_database(known, url):
+            return shard_id
+    shard_id = str(len(shard_urls))
+    shard_urls[shard_id] = url
+    return shard_id
+
+current_layout = [_shard_id(url) for url in _urls(settings.DATABASE_SHARD_URLS)] or [PRIMARY]
+previous_layout = [_shard_id(url) for url in _urls(settings.DATABASE_SHARD_URLS_PREVIOUS)]
+# С одним шардом (по умолчанию – основная БД) сессии и запросы те же, что без шардирования
+sharding_enabled = current_layout != [PRIMARY] or bool(previous_layout)
+link_shards = sorted(set(current_layout + previous_layout), key=int)
+
+def jump_hash(key: int, buckets: int) -> int:
+    # Lamping, Veach: "A Fast, Minimal Memory, Consistent Hash Algorithm"
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (1 << 31) / ((key >> 33) + 1))
+    return bucket
+
+def shard_for(short_code: str, layout=None) -> str:
+    layout = layout or current_layout
+    key = int.from_bytes(hashlib.blake2b(short_code.encode(), digest_size=8).digest(), "little")
+    return layout[jump_hash(key, len(layout))]
+
+def shards_for(short_code: str):
+    # Шард по новой раскладке и, пока идёт перешардирование, по прежней
+    shards = [shard_for(short_code)]
+    if previous_layout:
+        previous = shard_for(short_code, previous_layout)
+        if previous != shards[0]:
+            shards.append(previous)
+    return shards
+
+def split_by_shard(items, code_of, current_only: bool = False):
+    # {шард: элементы} для пакетной записи; без шардирования – {None: items}.
+    # Обновления идут во все шарды кода (строка может быть ещё в прежнем), вставки (current_only) –
+    # только в шард текущей раскладки, как и одиночное создание, иначе ссылка окажется в двух базах
+    if not sharding_enabled:
+        return {None: items}
+    groups = {}
+    for item in items:
+        shard_ids = [shard_for(code_of(item))] if current_only else shards_for(code_of(item))
+        for shard_id in shard_ids:
+            groups.setdefault(shard_id, []).append(item)
+    return groups
+
+def shard_bind(shard_id):
+    return {"shard_id": shard_id} if shard_id is not None else None
+
+def query_shards():
+    # Шарды для обхода таблицы links по одному; без шардирования – один проход обычной сессией
+    return link_shards if sharding_enabled else [None]
+
+def on_shard(query, shard_id):
+    return query.execution_options(_sa_shard_id=shard_id) if shard_id is not None else query
+
+def _is_sharded(mapper) -> bool:
+    return mapper is not None and mapper.local_table.name in SHARDED_TABLES
+
+def _and_clauses(criterion):
+    if isinstance(criterion, BooleanClauseList) and criterion.operator is operators.and_:
+        for clause in criterion.clauses:
+            yield from _and_clauses(clause)
+    else:
+        yield criterion
+
+def _short_codes(statement):
+    # Коды из условий short_code = :x и short_code IN (...) на верхнем уровне AND; None – кодов нет
+    for criterion in getattr(statement, "_where_criteria", ()):
+        for clause in _and_clauses(criterion):
+            if not isinstance(clause, BinaryExpression) or not isinstance(clause.right, BindParameter):
+                continue
+            column = clause.left
+            if getattr(column, "name", None) != "short_code" or getattr(column, "table", None) is None:
+                continue
+            if column.table.name not in SHARDED_TABLES:
+                continue
+            value = clause.right.effective_value
+            if value is None:
+                # Параметр executemany: значения не видны, пакет нужно разложить по шардам заранее
+                continue
+            if clause.operator is operators.eq:
+                return [value]
+            if clause.operator is operators.in_op:
+                return list(value)
+    return None
+
+# Выбор шардов для ShardedSession (sqlalchemy.ext.horizontal_shard)
+def shard_chooser(mapper, instance, clause=None):
+    if not _is_sharded(mapper):
+        return PRIMARY
+    if instance is None or not instance.short_code:
+        raise ValueError("Шард ссылки определяется по short_code")
+    return shard_for(instance.short_code)
+
+def id_chooser(query, ident):
+    entity = query.column_descriptions[0]["entity"]
+    return link_shards if _is_sharded(inspect(entity)) else [PRIMARY]
+
+def execute_chooser(orm_context):
+    if not _is_sharded(orm_context.bind_mapper):
+        return [PRIMARY]
+    if orm_context.is_insert:
+        raise ValueError("Пакетная вставка в links должна быть разложена по шардам (split_by_shard)")
+    codes = _short_codes(orm_context.statement)
+    if codes is None:
+        # Поиск не по коду (владелец, URL, условия очистки) – опрашиваются все шарды
+        return link_shards
+    shards = {shard_id for code in codes for shard_id in shards_for(code)}
+    return sorted(shards, key=int) or current_layout[:1]
@@ -0,0 +1,170 @@
+import threading
+import redis
+from sqlalchemy import func, literal_column, select
+from app.config import settings
+from app.caching import redis_client, async_redis_client
+from app import models
+from app.models import link_code_seq
+from app.utils import decode_short_code, encode_short_code, generate_short_code, obfuscation_key
+
+CODE_SEQUENCE_KEY = "links:code-seq"
+# Размер блока из последовательности – её шаг, а не CODE_BLOCK_SIZE: до миграции (app/migrations.py)
+# они расходятся, и блоки по настройке пересеклись бы
+SEQUENCE_INCREMENT = literal_column("(SELECT increment_by FROM pg_sequences WHERE sequencename = 'link_code_seq')")
+
+CODE_KEY = obfuscation_key(settings.CODE_OBFUSCATION_KEY) if settings.CODE_OBFUSCATE else None
+
+class IdBlockAllocator:
+    # Номера арендуются блоками (один INCRBY/nextval на CODE_BLOCK_SIZE ссылок)
+    # и выдаются из памяти воркера, поэтому два воркера никогда не получат один номер
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self._next < self._end:
+                value = self._next
+                self._next += 1
+                return value
+        return None
+
+    def discard(self):
+        # Остаток блока больше не выдаём: его номера уже заняты
+        with self._lock:
+            self._next = self._end
+
+    def install(self, start: int, size: int = None) -> int:
+        # Первый номер блока сразу отдаём вызывающему, остаток – в запас
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = start + 1, start + (size or self.block_size)
+        return start
+
+allocator = IdBlockAllocator(settings.CODE_BLOCK_SIZE)
+
+def _code_for(number: int) -> str:
+    return encode_short_code(number, settings.LINK_CODE_LENGTH, CODE_KEY)
+
+def _random_code() -> str:
+    # На символ длиннее кодов по номерам: не пересекается с ними и не сбивает засев счётчика
+    return generate_short_code(settings.LINK_CODE_LENGTH + 1)
+
+def _uses_sequence(db) -> bool:
+    return settings.CODE_ID_SOURCE == "postgres" and db.get_bind().dialect.supports_sequences
+
+# Засев счётчика в Redis. Счётчик мог пропасть (вытеснение ключа, failover без персистентности) –
+# тогда он продолжается с номера после наибольшего выданного; при совпадении кода с уже существующим
+# (счётчик восстановлен из старой копии) поднимается до него же
+def _issued_codes_query():
+    Link = models.Link
+    return select(Link.short_code).where(
+        Link.custom_alias == None, func.length(Link.short_code) == settings.LINK_CODE_LENGTH
+    ).execution_options(yield_per=10000)
+
+def _code_number(code: str) -> int:
+    try:
+        return decode_short_code(code, CODE_KEY)
+    except ValueError:
+        return -1
+
+def _next_unissued(codes) -> int:
+    return max((_code_number(code) for code in codes), default=-1) + 1
+
+def _apply_seed(seed: int):
+    if redis_client.set(CODE_SEQUENCE_KEY, seed, nx=True):
+        return
+    current = int(redis_client.get(CODE_SEQUENCE_KEY) or 0)
+    if current < seed:
+        # Параллельный засев может поднять счётчик дважды – пропуск номеров безопасен
+        redis_client.incrby(CODE_SEQUENCE_KEY, seed - current)
+
+def _seed_counter(db, force: bool = False):
+    if not force and redis_client.exists(CODE_SEQUENCE_KEY):
+        return
+    _apply_seed(_next_unissued(db.execute(_issued_codes_query()).scalars()))
+
+async def _seed_counter_async(db, force: bool = False):
+    if not force and await async_redis_client.exists(CODE_SEQUENCE_KEY):
+        return
+    seed = 0
+    async for code in await db.stream_scalars(_issued_codes_query()):
+        seed = max(seed, _code_number(code) + 1)
+    if not await async_redis_client.set(CODE_SEQUENCE_KEY, seed, nx=True):
+        current = int(await async_redis_client.get(CODE_SEQUENCE_KEY) or 0)
+        if current < seed:
+            await async_redis_client.incrby(CODE_SEQUENCE_KEY, seed - current)
+
+def _lease_block(db, reseed: bool = False):
+    # (первый номер, размер блока)
+    if _uses_sequence(db):
+        return tuple(db.execute(select(link_code_seq.next_value(), SEQUENCE_INCREMENT)).one())
+    _seed_counter(db, force=reseed)
+    return redis_client.incrby(CODE_SEQUENCE_KEY, allocator.block_size) - allocator.block_size, allocator.block_size
+
+async def _lease_block_async(db, reseed: bool = False):
+    if _uses_sequence(db):
+        return tuple((await db.execute(select(link_code_seq.next_value(), SEQUENCE_INCREMENT))).one())
+    await _seed_counter_async(db, force=reseed)
+    end = await async_redis_client.incrby(CODE_SEQUENCE_KEY, allocator.block_size)
+    return end - allocator.block_size, allocator.block_size
+
+def next_short_code(db, collided: bool = False) -> str:
+    # collided – предыдущий код уже оказался занят: блок бросаем и арендуем новый
+    if collided:
+        allocator.discard()
+    number = allocator.take()
+    if number is None:
+        try:
+            number = allocator.install(*_lease_block(db, reseed=collided))
+        except redis.RedisError:
+            # Без источника номеров – случайный код, уникальность проверит индекс
+            return _random_code()
+    return _code_for(number)
+
+async def next_short_code_async(db, collided: bool = False) -> str:
+    if collided:
+        allocator.discard()
+    number = allocator.take()
+    if number is None:
+        try:
+            number = allocator.install(*await _lease_block_async(db, reseed=collided))
+        except redis.RedisError:
+            return _random_code()
+    return _code_for(number)
+
+async def _lease_numbers_async(db, count: int):
+    if _uses_sequence(db):
+        # Последовательность шагает блоками, поэтому берём нужное число блоков одним запросом
+        # (повторным – если её шаг оказался меньше CODE_BLOCK_SIZE)
+        numbers = []
+        block_size = allocator.block_size
+        while len(numbers) < count:
+            blocks = -(-(count - len(numbers)) // block_size)
+            rows = await db.execute(
+                select(link_code_seq.next_value(), SEQUENCE_INCREMENT).select_from(func.generate_series(1, blocks))
+            )
+            for start, block_size in rows:
+                numbers.extend(range(start, start + block_size))
+        return numbers[:count]
+    await _seed_counter_async(db)
+    end = await async_redis_client.incrby(CODE_SEQUENCE_KEY, count)
+    return list(range(end - count, end))
+
+async def next_short_codes_async(db, count: int):
+    # Пачка кодов: сначала остаток текущего блока, недостающее – одним INCRBY/запросом
+    numbers = []
+    while len(numbers) < count:
+        number = allocator.take()
+        if number is None:
+            break
+        numbers.append(number)
+    missing = count - len(numbers)
+    if missing:
+        try:
+            numbers.extend(await _lease_numbers_async(db, missing))
+        except redis.RedisError:
+            return [_code_for(n) for n in numbers] + [_random_code() for _ in range(missing)]
+    return [_code_for(n) for n in numbers]
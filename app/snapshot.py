@@ -0,0 +1,374 @@
+import argparse
+import datetime
+import heapq
+import json
+import mmap
+import os
+import shutil
+import signal
+import struct
+import tempfile
+import threading
+import time
+import redis
+from app import models
+from app.caching import async_redis_client, cache_entry, redis_client
+from app.config import settings
+from app.sharding import on_shard, query_shards
+
+# Снимок short_code -> ссылка для парка перенаправлений без Postgres и Redis на пути запроса (app/edge.py).
+# Файл открывается через mmap только для чтения, поэтому все воркеры на машине делят одни страницы кэша ОС.
+# Формат: заголовок, отсортированные коды фиксированной ширины (двоичный поиск), смещения записей, записи.
+SNAPSHOT_MAGIC = b"SURLSNP1"
+# magic, число записей, время сборки (unix), позиция ленты изменений, до которой снимок актуален (ms, seq)
+HEADER = struct.Struct("<8sQdQQ")
+# Короткий код – до 20 символов; с запасом на не-ASCII алиасы в UTF-8
+KEY_SIZE = 32
+OFFSET = struct.Struct("<Q")
+# expires_at (unix, -1 – бессрочно), redirect_status (0 – по умолчанию), флаги, длина URL; затем URL
+RECORD = struct.Struct("<qHBI")
+FLAG_EXACT_CLICKS = 1
+
+# Лента изменений ссылок (Redis Stream): создания и удаления после фиксации в БД
+CHANGES_KEY = "links:changes"
+
+def _key(short_code: str):
+    key = short_code.encode()
+    return key.ljust(KEY_SIZE, b"\0") if len(key) <= KEY_SIZE else None
+
+def _encode_record(entry: dict) -> bytes:
+    url = entry["original_url"].encode()
+    expires_ts = -1
+    if entry["expires_at"]:
+        expires_at = datetime.datetime.fromisoformat(entry["expires_at"]).replace(tzinfo=datetime.timezone.utc)
+        expires_ts = int(expires_at.timestamp())
+    flags = FLAG_EXACT_CLICKS if entry.get("exact_clicks") else 0
+    return RECORD.pack(expires_ts, entry.get("redirect_status") or 0, flags, len(url)) + url
+
+def _decode_record(buf, offset: int) -> dict:
+    expires_ts, status, flags, url_len = RECORD.unpack_from(buf, offset)
+    start = offset + RECORD.size
+    expires_at = datetime.datetime.utcfromtimestamp(expires_ts) if expires_ts >= 0 else None
+    return cache_entry(buf[start:start + url_len].decode(), expires_at, status or None, bool(flags & FLAG_EXACT_CLICKS))
+
+def _parse_id(stream_id: str):
+    ms, seq = stream_id.split("-")
+    return int(ms), int(seq)
+
+class SnapshotWriter:
+    # Записи добавляются по возрастанию кода; файл собирается рядом с целевым и подменяет его атомарно
+    def __init__(self, path: str):
+        self.path = path
+        self._dir = os.path.dirname(os.path.abspath(path))
+        self._keys = tempfile.TemporaryFile(dir=self._dir)
+        self._offsets = tempfile.TemporaryFile(dir=self._dir)
+        self._data = tempfile.TemporaryFile(dir=self._dir)
+        self._data_size = 0
+        self._last_key = b""
+        self.count = 0
+
+    def add(self, key: bytes, record: bytes):
+        if key <= self._last_key:
+            raise ValueError(f"Коды снимка должны идти по возрастанию: {key.rstrip(bytes(1))!r}")
+        self._keys.write(key)
+        self._offsets.write(OFFSET.pack(self._data_size))
+        self._data.write(record)
+        self._data_size += len(record)
+        self._last_key = key
+        self.count += 1
+
+    def commit(self, feed_position):
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, prefix=".links-snapshot-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                out.write(HEADER.pack(SNAPSHOT_MAGIC, self.count, time.time(), *feed_position))
+                for part in (self._keys, self._offsets, self._data):
+                    part.seek(0)
+                    shutil.copyfileobj(part, out, 1 << 20)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        for part in (self._keys, self._offsets, self._data):
+            part.close()
+
+class Snapshot:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.built_at, ms, seq = HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC:
+            self._mm.close()
+            raise ValueError(f"{path} не является снимком ссылок")
+        self.feed_position = (ms, seq)
+        self._keys = HEADER.size
+        self._offsets = self._keys + self.count * KEY_SIZE
+        self._data = self._offsets + self.count * OFFSET.size
+
+    def _key_at(self, index: int) -> bytes:
+        start = self._keys + index * KEY_SIZE
+        return self._mm[start:start + KEY_SIZE]
+
+    def _record_at(self, index: int) -> int:
+        return self._data + OFFSET.unpack_from(self._mm, self._offsets + index * OFFSET.size)[0]
+
+    def lookup(self, short_code: str):
+        # Запись в формате кэша ссылок или None
+        key = _key(short_code)
+        if key is None:
+            return None
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count or self._key_at(lo) != key:
+            return None
+        return _decode_record(self._mm, self._record_at(lo))
+
+    def items(self):
+        # Пары (ключ, запись в байтах) по порядку – для слияния с лентой изменений
+        for index in range(self.count):
+            start = self._record_at(index)
+            url_len = RECORD.unpack_from(self._mm, start)[3]
+            yield self._key_at(index), self._mm[start:start + RECORD.size + url_len]
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "built_at": datetime.datetime.utcfromtimestamp(self.built_at).isoformat(),
+            "feed_position": "-".join(map(str, self.feed_position)),
+            "size": self.stat.st_size,
+        }
+
+    def close(self):
+        self._mm.close()
+
+# Текущий снимок процесса: раз в SNAPSHOT_CHECK_INTERVAL секунд сверяем файл и переоткрываем подменённый.
+# Обращения идут из event loop синхронно, поэтому старый снимок можно закрыть сразу после замены
+_current = {"snapshot": None, "checked": 0.0}
+
+def current_snapshot():
+    now = time.monotonic()
+    if now - _current["checked"] >= settings.SNAPSHOT_CHECK_INTERVAL:
+        _current["checked"] = now
+        _reload_snapshot()
+    return _current["snapshot"]
+
+def _reload_snapshot():
+    previous = _current["snapshot"]
+    try:
+        stat = os.stat(settings.SNAPSHOT_PATH)
+        if previous and (stat.st_ino, stat.st_mtime_ns) == (previous.stat.st_ino, previous.stat.st_mtime_ns):
+            return
+        _current["snapshot"] = Snapshot(settings.SNAPSHOT_PATH)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Не удалось открыть снимок {settings.SNAPSHOT_PATH}: {e}")
+        return
+    if previous:
+        previous.close()
+
+def _feed_messages(puts: dict, deletes):
+    for short_code, entry in puts.items():
+        yield {"op": "put", "code": short_code, "entry": json.dumps(entry)}
+    for short_code in deletes:
+        yield {"op": "del", "code": short_code}
+
+def publish_link_changes(puts: dict = None, deletes=()):
+    # Вызывается после фиксации в БД. Потерянное при сбое Redis изменение исправит полная перестройка снимка
+    if not settings.SNAPSHOT_CHANGE_FEED:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for fields in _feed_messages(puts or {}, deletes):
+            pipe.xadd(CHANGES_KEY, fields, maxlen=settings.SNAPSHOT_FEED_MAXLEN, approximate=True)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"Не удалось записать изменения ссылок в ленту: {e}")
+
+async def publish_link_changes_async(puts: dict = None, deletes=()):
+    if not settings.SNAPSHOT_CHANGE_FEED:
+        return
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        for fields in _feed_messages(puts or {}, deletes):
+            pipe.xadd(CHANGES_KEY, fields, maxlen=settings.SNAPSHOT_FEED_MAXLEN, approximate=True)
+        await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Не удалось записать изменения ссылок в ленту: {e}")
+
+def _feed_head():
+    last = redis_client.xrevrange(CHANGES_KEY, count=1)
+    return _parse_id(last[0][0]) if last else (0, 0)
+
+def read_changes(after):
+    # Последнее изменение по каждому коду после позиции after: {ключ: запись или None для удаления}.
+    # None вместо словаря – часть ленты после after уже обрезана, нужна полная перестройка
+    try:
+        info = redis_client.xinfo_stream(CHANGES_KEY)
+    except redis.ResponseError:
+        return {}, after
+    trimmed = info.get("max-deleted-entry-id")
+    if trimmed is not None:
+        lost = _parse_id(trimmed) > after
+    else:
+        # До Redis 7 точной отметки нет: считаем ленту обрезанной, если она заполнена и начинается позже
+        first = info.get("first-entry")
+        lost = bool(first) and _parse_id(first[0]) > after and info["length"] >= settings.SNAPSHOT_FEED_MAXLEN
+    if lost:
+        return None, after
+    changes = {}
+    position = after
+    while True:
+        entries = redis_client.xrange(
+            CHANGES_KEY, min=f"{position[0]}-{position[1] + 1}", count=settings.SNAPSHOT_BATCH_SIZE
+        )
+        for stream_id, fields in entries:
+            key = _key(fields["code"])
+            if key is not None:
+                changes[key] = _encode_record(json.loads(fields["entry"])) if fields["op"] == "put" else None
+        if not entries:
+            return changes, position
+        position = _parse_id(entries[-1][0])
+
+def _merge(existing, changes: dict):
+    pending = iter(sorted(changes.items()))
+    change = next(pending, None)
+    for key, record in existing:
+        while change is not None and change[0] < key:
+            if change[1] is not None:
+                yield change
+            change = next(pending, None)
+        if change is not None and change[0] == key:
+            if change[1] is not None:
+                yield change
+            change = next(pending, None)
+            continue
+        yield key, record
+    while change is not None:
+        if change[1] is not None:
+            yield change
+        change = next(pending, None)
+
+def build_snapshot(db, path: str = None):
+    # Полная сборка из таблицы links. Позиция ленты берётся до чтения таблицы: изменения, пришедшие
+    # во время сборки, будут применены повторно, а повтор создания или удаления ничего не портит
+    path = path or settings.SNAPSHOT_PATH
+    position = _feed_head()
+    Link = models.Link
+    # Порядок кодов должен совпадать с побайтовым сравнением, а не с правилами сортировки БД
+    order = Link.short_code.collate("C") if db.get_bind().dialect.name == "postgresql" else Link.short_code
+    query = db.query(
+        Link.short_code, Link.original_url, Link.expires_at, Link.redirect_status, Link.exact_clicks
+    ).order_by(order)
+    # С шардами – слияние отсортированных потоков всех шардов
+    rows = heapq.merge(
+        *(on_shard(query, shard_id).yield_per(settings.SNAPSHOT_BATCH_SIZE) for shard_id in query_shards()),
+        key=lambda row: row.short_code.encode(),
+    )
+    writer = SnapshotWriter(path)
+    last_key = None
+    try:
+        for row in rows:
+            key = _key(row.short_code)
+            if key is None:
+                print(f"Код {row.short_code} длиннее {KEY_SIZE} байт и не попадёт в снимок")
+                continue
+            if key == last_key:
+                # Во время перешардирования ссылка может оказаться в двух шардах
+                continue
+            last_key = key
+            writer.add(key, _encode_record(cache_entry(row.original_url, row.expires_at, row.redirect_status, row.exact_clicks)))
+    except BaseException:
+        writer.close()
+        raise
+    db.rollback()
+    writer.commit(position)
+    return writer.count
+
+def update_snapshot(path: str = None):
+    # Применение ленты изменений к текущему снимку без обращения к БД: слияние за один проход.
+    # Возвращает число изменённых кодов или None, если нужна полная перестройка
+    path = path or settings.SNAPSHOT_PATH
+    snapshot = Snapshot(path)
+    try:
+        changes, position = read_changes(snapshot.feed_position)
+        if changes is None:
+            return None
+        if not changes:
+            return 0
+        writer = SnapshotWriter(path)
+        try:
+            for key, record in _merge(snapshot.items(), changes):
+                writer.add(key, record)
+        except BaseException:
+            writer.close()
+            raise
+        writer.commit(position)
+        return len(changes)
+    finally:
+        snapshot.close()
+
+def _built_at(path: str) -> float:
+    with open(path, "rb") as f:
+        return HEADER.unpack(f.read(HEADER.size))[2]
+
+def _rebuild(path: str):
+    from app.database import SessionLocal
+    started = time.monotonic()
+    db = SessionLocal()
+    try:
+        count = build_snapshot(db, path)
+    finally:
+        db.close()
+    print(f"Снимок {path} собран из БД: {count} ссылок за {time.monotonic() - started:.2f} с")
+
+def follow(path: str):
+    # Процесс-сопровождающий на каждой машине парка: применяет ленту раз в SNAPSHOT_UPDATE_INTERVAL
+    # и собирает снимок заново раз в SNAPSHOT_REBUILD_INTERVAL или после обрезки ленты
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    while not stop.is_set():
+        try:
+            fresh = os.path.exists(path) and time.time() - _built_at(path) < settings.SNAPSHOT_REBUILD_INTERVAL
+            if not fresh or update_snapshot(path) is None:
+                _rebuild(path)
+        except Exception as e:
+            print(f"Ошибка обновления снимка {path}: {e}")
+        try:
+            stop.wait(settings.SNAPSHOT_UPDATE_INTERVAL)
+        except KeyboardInterrupt:
+            break
+
+def main():
+    #   python -m app.snapshot build    – собрать снимок из БД
+    #   python -m app.snapshot update   – применить ленту изменений
+    #   python -m app.snapshot follow   – поддерживать снимок актуальным
+    parser = argparse.ArgumentParser(description="Снимок ссылок для парка перенаправлений")
+    parser.add_argument("command", choices=("build", "update", "follow"))
+    parser.add_argument("--path", default=settings.SNAPSHOT_PATH)
+    args = parser.parse_args()
+    if args.command == "build":
+        _rebuild(args.path)
+    elif args.command == "update":
+        applied = update_snapshot(args.path)
+        if applied is None:
+            _rebuild(args.path)
+        else:
+            print(f"Применено изменений: {applied}")
+    else:
+        follow(args.path)
+
+if __name__ == "__main__":
+    main()
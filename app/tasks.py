@@ -1,37 +1,201 @@
-import time
+import argparse
+import datetime
+import random
+import signal
 import threading
+import time
+import uuid
+import redis
 from app.database import SessionLocal
-from app.crud import delete_expired_links, delete_unused_links
+from app.crud import delete_due_links, delete_expired_links, delete_unused_links, flush_redirect_counts
+from app.caching import redis_client, release_lock, renew_lock
+from app.bloom import rebuild_filter, repair_filter
 from app.config import settings
+from app.metrics import JOB_RUNS, observe_job
+
+LAST_RUN_TTL_MARGIN = 0.9
 
-def cleanup_expired_links():
-    while True:
+class PeriodicJob:
+    # Периодическая задача. При exclusive=True на время выполнения берётся блокировка в Redis
+    # (продлевается, пока задача идёт), а после запуска ставится метка последнего запуска,
+    # поэтому со всех воркеров и реплик задача выполняется по одной и примерно раз за интервал
+    def __init__(self, name: str, func, interval: float, exclusive: bool = True):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.exclusive = exclusive
+        self.runs = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_duration = None
+        self.last_rows = None
+        self.last_success_at = None
+        self.last_error = None
+        self.lock_lost = 0
+        self._lock_key = f"scheduler:lock:{name}"
+        self._last_run_key = f"scheduler:last-run:{name}"
+
+    def _acquire(self):
+        # Токен блокировки; None – задача уже идёт на другом узле или недавно выполнялась
+        if not self.exclusive:
+            return ""
+        token = uuid.uuid4().hex
         try:
-            db = SessionLocal()
-            count = delete_expired_links(db)
-            if count:
-                print(f"Удалено просроченных ссылок: {count}")
-        except Exception as e:
-            print(f"Ошибка при удалении просроченных ссылок: {e}")
-        finally:
-            db.close()
-        time.sleep(3600)
+            if not redis_client.set(self._lock_key, token, nx=True, px=int(settings.SCHEDULER_LOCK_TTL * 1000)):
+                return None
+            if redis_client.exists(self._last_run_key):
+                self._release(token)
+                return None
+            # Метка короче самой ранней следующей попытки (интервал минус разброс) с запасом:
+            # иначе тот же воркер, проснувшись раньше интервала, пропускал бы собственный запуск
+            ttl = self.interval * (1 - settings.SCHEDULER_JITTER) * LAST_RUN_TTL_MARGIN
+            redis_client.set(self._last_run_key, 1, px=max(1, int(ttl * 1000)))
+        except redis.RedisError as e:
+            print(f"Не удалось получить блокировку задачи {self.name}: {e}")
+            return None
+        return token
+
+    def _release(self, token: str):
+        if not token:
+            return
+        try:
+            release_lock(keys=[self._lock_key], args=[token])
+        except redis.RedisError:
+            pass
+
+    def _keep_lock(self, token: str, done: threading.Event):
+        # Продление блокировки, пока задача выполняется; потерянную блокировку видно в stats
+        ttl_ms = int(settings.SCHEDULER_LOCK_TTL * 1000)
+        while not done.wait(settings.SCHEDULER_LOCK_TTL / 3):
+            try:
+                renewed = renew_lock(keys=[self._lock_key], args=[token, ttl_ms])
+            except redis.RedisError:
+                continue
+            if not renewed:
+                self.lock_lost += 1
+                return
 
-def cleanup_unused_links():
-    while True:
+    def run_once(self, force: bool = False):
+        token = "" if force else self._acquire()
+        if token is None:
+            self.skipped += 1
+            JOB_RUNS.labels(self.name, "skipped").inc()
+            return None
+        done = threading.Event()
+        if token:
+            threading.Thread(target=self._keep_lock, args=(token, done), name=f"job-{self.name}-lock", daemon=True).start()
+        started = time.monotonic()
+        db = SessionLocal()
         try:
-            db = SessionLocal()
-            count = delete_unused_links(db, settings.INACTIVE_DAYS)
-            if count:
-                print(f"Удалено неиспользуемых ссылок: {count}")
+            rows = self.func(db)
         except Exception as e:
-            print(f"Ошибка при удалении неиспользуемых ссылок: {e}")
+            self.failures += 1
+            self.last_error = str(e)
+            JOB_RUNS.labels(self.name, "failure").inc()
+            print(f"Ошибка в задаче {self.name}: {e}")
+            return None
         finally:
             db.close()
-        time.sleep(3600)
+            done.set()
+            self._release(token)
+        self.runs += 1
+        self.last_duration = time.monotonic() - started
+        self.last_rows = rows
+        self.last_success_at = datetime.datetime.utcnow()
+        observe_job(self.name, self.last_duration, rows)
+        if rows:
+            print(f"Задача {self.name}: обработано строк {rows} за {self.last_duration:.2f} с")
+        return rows
+
+    def next_delay(self) -> float:
+        # Разброс, чтобы воркеры не просыпались одновременно
+        jitter = self.interval * settings.SCHEDULER_JITTER
+        return max(0.0, self.interval + random.uniform(-jitter, jitter))
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "failures": self.failures,
+            "last_duration": self.last_duration,
+            "last_rows": self.last_rows,
+            "last_success_at": self.last_success_at.isoformat() if self.last_success_at else None,
+            "last_error": self.last_error,
+            "lock_lost": self.lock_lost,
+        }
+
+jobs = {
+    # Ссылки из очереди истечения удаляются через секунды; полная очистка по индексу expires_at –
+    # страховка для ссылок, не попавших в очередь (создание без Redis, ссылки до появления очереди)
+    "expiring": PeriodicJob("expiring", delete_due_links, settings.EXPIRY_QUEUE_INTERVAL),
+    "expired": PeriodicJob("expired", delete_expired_links, settings.CLEANUP_EXPIRED_INTERVAL),
+    "unused": PeriodicJob(
+        "unused", lambda db: delete_unused_links(db, settings.INACTIVE_DAYS), settings.CLEANUP_UNUSED_INTERVAL
+    ),
+    # Перестройка фильтра Блума убирает из него удалённые коды
+    "bloom": PeriodicJob("bloom", rebuild_filter, settings.BLOOM_REBUILD_INTERVAL),
+    # Досрочная перестройка, если запись в фильтр не удалась и он помечен грязным
+    "bloom-repair": PeriodicJob("bloom-repair", repair_filter, settings.BLOOM_REPAIR_INTERVAL),
+    # Сброс счётчиков защищён собственной блокировкой и идёт в каждом воркере
+    "clicks": PeriodicJob("clicks", flush_redirect_counts, settings.CLICK_FLUSH_INTERVAL, exclusive=False),
+}
+
+_stop_event = threading.Event()
+_threads = []
+
+def _job_loop(job: PeriodicJob):
+    # Первый запуск тоже со случайной задержкой, чтобы рестарт флота не давал пик
+    if _stop_event.wait(random.uniform(0, job.interval * settings.SCHEDULER_JITTER)):
+        return
+    while not _stop_event.is_set():
+        job.run_once()
+        _stop_event.wait(job.next_delay())
+
+def start_scheduler():
+    _stop_event.clear()
+    for job in jobs.values():
+        thread = threading.Thread(target=_job_loop, args=(job,), name=f"job-{job.name}", daemon=True)
+        thread.start()
+        _threads.append(thread)
+
+def stop_scheduler(timeout: float = 10.0):
+    _stop_event.set()
+    for thread in _threads:
+        thread.join(timeout)
+    _threads.clear()
+
+def jobs_stats() -> dict:
+    return {name: job.stats() for name, job in jobs.items()}
+
+def main():
+    # Запуск фоновых задач отдельным процессом (cron или воркер) вместо веб-процесса:
+    #   python -m app.tasks            – работать постоянно
+    #   python -m app.tasks --once expired unused
+    parser = argparse.ArgumentParser(description="Фоновые задачи сервиса сокращения ссылок")
+    parser.add_argument("jobs", nargs="*", help=f"задачи: {', '.join(jobs)} (по умолчанию все)")
+    parser.add_argument("--once", action="store_true", help="выполнить по одному разу и выйти")
+    parser.add_argument("--force", action="store_true", help="не брать распределённую блокировку")
+    args = parser.parse_args()
+    unknown = [name for name in args.jobs if name not in jobs]
+    if unknown:
+        parser.error(f"неизвестные задачи: {', '.join(unknown)}")
+    selected = args.jobs or list(jobs)
+    if args.once:
+        for name in selected:
+            rows = jobs[name].run_once(force=args.force)
+            print(f"{name}: {rows}")
+        return
+    for name in list(jobs):
+        if name not in selected:
+            del jobs[name]
+    signal.signal(signal.SIGTERM, lambda *_: _stop_event.set())
+    start_scheduler()
+    try:
+        _stop_event.wait()
+    except KeyboardInterrupt:
+        pass
+    stop_scheduler()
 
-def schedule_cleanup_task():
-    thread1 = threading.Thread(target=cleanup_expired_links, daemon=True)
-    thread1.start()
-    thread2 = threading.Thread(target=cleanup_unused_links, daemon=True)
-    thread2.start()
+if __name__ == "__main__":
+    main()
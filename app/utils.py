@@ -1,10 +1,93 @@
+import datetime
+import hashlib
 import random
 import string
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+BASE62_ALPHABET = string.digits + string.ascii_lowercase + string.ascii_uppercase
+# Перестановка номеров кодов – сеть Фейстеля с ключом: по одному коду нельзя вычислить соседние
+FEISTEL_ROUNDS = 8
 
 def generate_short_code(length: int = 6) -> str:
     characters = string.ascii_letters + string.digits
     return ''.join(random.choices(characters, k=length))
 
+def encode_base62(number: int) -> str:
+    if number == 0:
+        return BASE62_ALPHABET[0]
+    chars = []
+    while number:
+        number, rem = divmod(number, 62)
+        chars.append(BASE62_ALPHABET[rem])
+    return ''.join(reversed(chars))
+
+def decode_base62(code: str) -> int:
+    number = 0
+    for char in code:
+        number = number * 62 + BASE62_ALPHABET.index(char)
+    return number
+
+def obfuscation_key(secret: str) -> bytes:
+    return hashlib.blake2b(secret.encode(), digest_size=32).digest()
+
+def _round_value(key: bytes, round_index: int, value: int, modulus: int) -> int:
+    digest = hashlib.blake2b(f"{round_index}:{value}".encode(), key=key, digest_size=8).digest()
+    return int.from_bytes(digest, "big") % modulus
+
+def _feistel(number: int, length: int, key: bytes, inverse: bool = False) -> int:
+    # Биекция на [0, 62^length): номер делится на две «половины» по основаниям 62^a и 62^b,
+    # в каждом раунде половины меняются местами (чётное число раундов возвращает исходные основания)
+    left_size, right_size = 62 ** (length // 2), 62 ** (length - length // 2)
+    left, right = divmod(number, right_size)
+    if not inverse:
+        for round_index in range(FEISTEL_ROUNDS):
+            left, right = right, (left + _round_value(key, round_index, right, left_size)) % left_size
+            left_size, right_size = right_size, left_size
+    else:
+        for round_index in reversed(range(FEISTEL_ROUNDS)):
+            left_size, right_size = right_size, left_size
+            left, right = (right - _round_value(key, round_index, left, left_size)) % left_size, left
+    return left * right_size + right
+
+def encode_short_code(number: int, length: int = 6, key: bytes = None) -> str:
+    # Разные номера всегда дают разные коды: номера меньше 62^length кодируются ровно в length
+    # символов, остальные – в столько, сколько нужно. С ключом номер переставляется внутри
+    # множества кодов той же длины
+    length = max(length, len(encode_base62(number)))
+    if key:
+        number = _feistel(number, length, key)
+    return encode_base62(number).rjust(length, BASE62_ALPHABET[0])
+
+def decode_short_code(code: str, key: bytes = None) -> int:
+    number = decode_base62(code)
+    return _feistel(number, len(code), key, inverse=True) if key else number
+
+def to_naive_utc(value):
+    # В БД, кэше и снимке время хранится без часового пояса, в UTC
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def normalize_url(url: str) -> str:
+    # Приводит тривиально различающиеся URL к одному виду: регистр схемы и хоста,
+    # порт по умолчанию, пустой путь, порядок параметров запроса, фрагмент
+    parts = urlsplit(str(url).strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    if parts.username:
+        userinfo = parts.username + (f":{parts.password}" if parts.password else "")
+        host = f"{userinfo}@{host}"
+    path = parts.path or "/"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, path, query, ""))
+
+def url_hash(url: str) -> str:
+    return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
 def verify_custom_alias(custom_alias: str) -> bool:
     allowed_chars = string.ascii_letters + string.digits + "-_"
     return all(c in allowed_chars for c in custom_alias)
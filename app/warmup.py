@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+import time
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+from app import crud_async
+from app.caching import async_redis_client, get_hot_links_async, link_to_cache, local_cache, redis_client, set_cached_links_async
+from app.config import settings
+from app.database import async_engine, async_read_session, engine
+from app.security import warm_up_executor
+
+# Состояние прогрева для пробы готовности: воркер принимает запросы сразу после старта,
+# а балансировщик направляет трафик, когда /health/ready отвечает 200
+state = {"ready": False, "started_at": None, "duration": None, "steps": {}}
+
+# Без этих шагов воркер не может обслуживать запросы; остальные только ускоряют первые запросы
+REQUIRED_STEPS = ("database",)
+
+async def _warm_database():
+    # Открываем соединения заранее, чтобы первые запросы не ждали установления соединения
+    count = max(1, settings.WARMUP_DB_CONNECTIONS)
+
+    async def ping_async():
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    def ping_sync():
+        connections = [engine.connect() for _ in range(count)]
+        try:
+            for conn in connections:
+                conn.execute(text("SELECT 1"))
+        finally:
+            for conn in connections:
+                conn.close()
+
+    # Соединения открываются одновременно, а не друг за другом
+    await asyncio.gather(run_in_threadpool(ping_sync), *[ping_async() for _ in range(count)])
+    return count
+
+async def _warm_redis():
+    await async_redis_client.ping()
+    await run_in_threadpool(redis_client.ping)
+    return True
+
+async def _warm_hot_links():
+    if settings.WARMUP_HOT_LINKS <= 0:
+        return 0
+    codes, cached = await get_hot_links_async(settings.WARMUP_HOT_LINKS)
+    for short_code, link_data in cached.items():
+        local_cache.set(short_code, link_data)
+    missing = [code for code in codes if code not in cached]
+    if missing:
+        # Ссылки, выпавшие из Redis (например, после его перезапуска), берём из БД одним запросом
+        now = datetime.datetime.utcnow()
+        async with async_read_session() as db:
+            rows = await crud_async.get_links_by_codes(db, missing)
+        await set_cached_links_async({
+            row.short_code: link_to_cache(row)
+            for row in rows
+            if row.expires_at is None or row.expires_at > now
+        })
+    return len(codes)
+
+async def _warm_ui():
+    from app.routers.frontend import prerender_pages
+    return await run_in_threadpool(prerender_pages)
+
+async def _warm_passwords():
+    await run_in_threadpool(warm_up_executor)
+    return settings.PASSWORD_WORKERS
+
+STEPS = {
+    "database": _warm_database,
+    "redis": _warm_redis,
+    "hot_links": _warm_hot_links,
+    "ui": _warm_ui,
+    "passwords": _warm_passwords,
+}
+
+async def _run_step(name: str, func):
+    started = time.monotonic()
+    try:
+        result = await func()
+    except Exception as e:
+        state["steps"][name] = {"ok": False, "error": str(e), "duration": round(time.monotonic() - started, 4)}
+        print(f"Прогрев {name} не удался: {e}")
+        return
+    state["steps"][name] = {"ok": True, "result": result, "duration": round(time.monotonic() - started, 4)}
+
+def _failed_required():
+    return [name for name in REQUIRED_STEPS if not state["steps"].get(name, {}).get("ok")]
+
+async def warm_up():
+    # Все шаги независимы и идут параллельно; обязательные повторяются, пока не пройдут
+    state["ready"] = False
+    state["started_at"] = datetime.datetime.utcnow().isoformat()
+    started = time.monotonic()
+    await asyncio.gather(*[_run_step(name, func) for name, func in STEPS.items()])
+    delay = 0.5
+    while _failed_required():
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 10)
+        await asyncio.gather(*[_run_step(name, STEPS[name]) for name in _failed_required()])
+    state["duration"] = round(time.monotonic() - started, 4)
+    state["ready"] = True
+    return state
@@ -0,0 +1,224 @@
+# Воспроизводимый бенчмарк без внешних сервисов: SQLite вместо Postgres и fakeredis вместо Redis.
+# Запросы идут в приложение напрямую через ASGI (httpx.AsyncClient), сеть не участвует.
+#   pip install -r benchmarks/requirements.txt
+#   python benchmarks/bench.py --rows 100000 --iterations 2000 --output result.json
+#   python benchmarks/bench.py --rows 100000 --compare result.json
+# Абсолютные числа на SQLite отличаются от Postgres, но подходят для сравнения версий между собой.
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common import summarize
+
+
+def setup_environment(db_path: str):
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["REDIS_URL"] = "redis://localhost:6379/0"
+    os.environ.setdefault("RUN_SCHEDULER_IN_WEB", "false")
+    os.environ.setdefault("CLEANUP_BATCH_PAUSE", "0")
+    # Фиксированные ключи: коды и токены одинаковы от запуска к запуску, сравнение --compare воспроизводимо
+    os.environ["SECRET_KEY"] = "bench-secret-key"
+    os.environ["CODE_OBFUSCATION_KEY"] = "bench-code-key"
+    # Все клиенты Redis приложения работают с одним общим in-process сервером
+    import fakeredis
+    import fakeredis.aioredis
+    import redis
+    import redis.asyncio
+    server = fakeredis.FakeServer()
+
+    def sync_from_url(cls, url, **kwargs):
+        return fakeredis.FakeRedis(server=server, decode_responses=kwargs.get("decode_responses", False))
+
+    def async_from_url(cls, url, **kwargs):
+        return fakeredis.aioredis.FakeRedis(server=server, decode_responses=kwargs.get("decode_responses", False))
+
+    redis.Redis.from_url = classmethod(sync_from_url)
+    redis.asyncio.Redis.from_url = classmethod(async_from_url)
+
+
+def seed_links(rows: int, expired_fraction: float):
+    from app import models
+    from app.database import engine
+    from app.utils import encode_short_code, url_hash
+    now = datetime.datetime.utcnow()
+    batch = []
+    codes = []
+    with engine.begin() as conn:
+        for i in range(rows):
+            code = "s" + encode_short_code(i, 6)
+            url = f"https://bench.example.com/page/{i}"
+            expired = random.random() < expired_fraction
+            batch.append({
+                "original_url": url,
+                "original_url_hash": url_hash(url),
+                "short_code": code,
+                "created_at": now,
+                "expires_at": now - datetime.timedelta(days=1) if expired else None,
+                "redirect_count": 0,
+            })
+            if not expired:
+                codes.append(code)
+            if len(batch) >= 5000:
+                conn.execute(models.Link.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(models.Link.__table__.insert(), batch)
+    return codes
+
+
+async def measure(name, iterations, request, prepare=None):
+    latencies = []
+    statuses = {}
+    started = time.perf_counter()
+    for i in range(iterations):
+        if prepare:
+            prepare(i)
+        t0 = time.perf_counter()
+        status_code = await request(i)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        statuses[status_code] = statuses.get(status_code, 0) + 1
+    elapsed = time.perf_counter() - started
+    return name, summarize(latencies, elapsed, statuses=statuses)
+
+
+async def run_scenarios(args, codes):
+    import httpx
+    from app.main import app
+    from app.caching import redis_client, local_cache
+    from app import crud
+    from app.database import SessionLocal
+
+    def drop_link_cache(code):
+        local_cache.delete(code)
+        redis_client.delete(f"link:{code}")
+
+    results = {}
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        hot = codes[: max(1, min(len(codes), 100))]
+
+        async def redirect(code):
+            return (await client.get(f"/links/{code}", follow_redirects=False)).status_code
+
+        for code in hot:
+            await redirect(code)
+        name, result = await measure("redirect_hit", args.iterations, lambda i: redirect(hot[i % len(hot)]))
+        results[name] = result
+
+        cold = random.sample(codes, min(len(codes), args.iterations))
+        name, result = await measure(
+            "redirect_miss", len(cold), lambda i: redirect(cold[i]), prepare=lambda i: drop_link_cache(cold[i])
+        )
+        results[name] = result
+
+        name, result = await measure(
+            "redirect_unknown", args.iterations, lambda i: redirect(f"zz{i}")
+        )
+        results[name] = result
+
+        async def shorten(i):
+            resp = await client.post("/links/shorten", json={"original_url": f"https://bench.example.com/new/{i}"})
+            return resp.status_code
+
+        name, result = await measure("shorten", args.iterations, shorten)
+        results[name] = result
+
+        async def stats(i):
+            return (await client.get(f"/links/{hot[i % len(hot)]}/stats")).status_code
+
+        name, result = await measure("stats", args.iterations, stats)
+        results[name] = result
+
+        search_ids = [random.randrange(args.rows) for _ in range(args.iterations)]
+
+        async def search(i):
+            url = f"https://bench.example.com/page/{search_ids[i]}"
+            return (await client.get("/links/search", params={"original_url": url})).status_code
+
+        name, result = await measure("search", args.iterations, search)
+        results[name] = result
+
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        removed = crud.delete_expired_links(db)
+        elapsed = time.perf_counter() - started
+    finally:
+        db.close()
+    results["cleanup_expired"] = {
+        "rows": removed,
+        "elapsed_s": round(elapsed, 4),
+        "rows_per_s": round(removed / elapsed, 1) if elapsed else 0.0,
+    }
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(current, previous):
+    lines = []
+    for name, result in current["results"].items():
+        before = previous.get("results", {}).get(name)
+        if not before:
+            continue
+        for metric in ("p50_ms", "p99_ms", "rps", "rows_per_s"):
+            if metric in result and before.get(metric):
+                delta = (result[metric] - before[metric]) / before[metric] * 100
+                lines.append(f"{name:18} {metric:10} {before[metric]:>12} -> {result[metric]:>12} ({delta:+.1f}%)")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк сервиса на SQLite и fakeredis")
+    parser.add_argument("--rows", type=int, default=10000, help="размер таблицы links")
+    parser.add_argument("--iterations", type=int, default=1000, help="запросов на сценарий")
+    parser.add_argument("--expired-fraction", type=float, default=0.1, help="доля просроченных ссылок")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="куда записать JSON с результатами")
+    parser.add_argument("--compare", help="JSON предыдущего запуска для сравнения")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup_environment(os.path.join(tmp, "bench.db"))
+        from app.database import engine
+        from app.migrations import run_migrations
+        run_migrations(engine)
+        codes = seed_links(args.rows, args.expired_fraction)
+        results = asyncio.run(run_scenarios(args, codes))
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "rows": args.rows,
+        "iterations": args.iterations,
+        "expired_fraction": args.expired_fraction,
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(report, json.load(f)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
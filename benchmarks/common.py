@@ -0,0 +1,23 @@
+import statistics
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(latencies_ms, elapsed_s, **extra):
+    result = {
+        "requests": len(latencies_ms),
+        "elapsed_s": round(elapsed_s, 4),
+        "rps": round(len(latencies_ms) / elapsed_s, 1) if elapsed_s else 0.0,
+        "p50_ms": round(percentile(latencies_ms, 50), 3),
+        "p95_ms": round(percentile(latencies_ms, 95), 3),
+        "p99_ms": round(percentile(latencies_ms, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies_ms), 3) if latencies_ms else 0.0,
+    }
+    result.update(extra)
+    return result
@@ -0,0 +1,68 @@
+# Нагрузочный тест перенаправлений: много одновременных GET /links/{short_code}
+# против запущенного сервиса, например:
+#   uvicorn app.main:app --workers 1
+#   python benchmarks/load_redirect.py --base-url http://localhost:8000 --concurrency 2000
+# Для сравнения с синхронными обработчиками запустите тот же тест на предыдущем коммите.
+import argparse
+import asyncio
+import json
+import time
+import httpx
+from common import summarize
+
+
+async def create_links(client: httpx.AsyncClient, count: int):
+    codes = []
+    for i in range(count):
+        resp = await client.post("/links/shorten", json={"original_url": f"https://example.com/load/{i}"})
+        resp.raise_for_status()
+        codes.append(resp.json()["short_code"])
+    return codes
+
+
+async def run(base_url: str, links: int, requests: int, concurrency: int):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        codes = await create_links(client, links)
+        latencies = []
+        errors = 0
+        queue = asyncio.Queue()
+        for i in range(requests):
+            queue.put_nowait(codes[i % len(codes)])
+
+        async def worker():
+            nonlocal errors
+            while True:
+                try:
+                    code = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                start = time.perf_counter()
+                try:
+                    resp = await client.get(f"/links/{code}", follow_redirects=False)
+                    if resp.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return summarize(latencies, elapsed, concurrency=concurrency, errors=errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест перенаправлений")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--links", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    args = parser.parse_args()
+    result = asyncio.run(run(args.base_url, args.links, args.requests, args.concurrency))
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
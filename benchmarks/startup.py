@@ -0,0 +1,91 @@
+# Время холодного старта воркера: каждый запуск – новый процесс интерпретатора.
+# Меряется импорт приложения, выполнение lifespan до приёма запросов и время до готовности (/health/ready).
+# Внешние сервисы не нужны: SQLite и fakeredis, как в bench.py.
+#   python benchmarks/startup.py --runs 10 --output startup.json
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common import percentile
+
+
+def child(db_path: str, migrate: bool):
+    started = time.perf_counter()
+    from bench import setup_environment
+    setup_environment(db_path)
+    os.environ["PASSWORD_EXECUTOR"] = "thread"
+    if migrate:
+        from app.database import engine
+        from app.migrations import run_migrations
+        run_migrations(engine)
+        return
+    from app.main import app
+    from app.warmup import state
+    imported = time.perf_counter()
+
+    async def run():
+        async with app.router.lifespan_context(app):
+            serving = time.perf_counter()
+            while not state["ready"]:
+                await asyncio.sleep(0.001)
+            return serving, time.perf_counter()
+
+    serving, ready = asyncio.run(run())
+    print(json.dumps({
+        "import_ms": (imported - started) * 1000,
+        "serving_ms": (serving - started) * 1000,
+        "ready_ms": (ready - started) * 1000,
+        "steps": state["steps"],
+    }))
+
+
+def run_child(db_path: str, migrate: bool = False):
+    command = [sys.executable, os.path.abspath(__file__), "--child", "--db", db_path]
+    if migrate:
+        command.append("--migrate")
+    output = subprocess.check_output(command, cwd=ROOT, text=True)
+    return json.loads(output.strip().splitlines()[-1]) if not migrate else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк холодного старта воркера")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--output", help="куда записать JSON с результатами")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--migrate", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.db, args.migrate)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "startup.db")
+        run_child(db_path, migrate=True)
+        runs = [run_child(db_path) for _ in range(args.runs)]
+
+    report = {"runs": args.runs}
+    for metric in ("import_ms", "serving_ms", "ready_ms"):
+        values = [run[metric] for run in runs]
+        report[metric] = {
+            "p50": round(percentile(values, 50), 1),
+            "max": round(max(values), 1),
+        }
+    report["last_steps"] = runs[-1]["steps"]
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()